@@ -9,7 +9,8 @@
 import objc
 from Foundation import *
 
-import cctagutils
+import socket
+import cctagutils.server
 
 class PyMetadataImport (NSObject):
 
@@ -17,17 +18,22 @@ class PyMetadataImport (NSObject):
 	def getMetadataForFile_ofType_withAttributes_(self, filepath, type_uti, attributes):
 		NSLog(filepath)
 		
-		meta = cctagutils.metadata.metadata(filepath)
-		claim = meta.getClaim()
-		if claim is None:
-			# the file does not contain a license claim
-			attributes['org_creativecommons_license'] = ['(not licensed)']
-		else:
-			attributes['org_creativecommons_license'] = [cctagutils.lookup.parseClaim(claim)['license']] 
+		# delegate to the extraction server if one is running; otherwise
+		# load the tagging libraries and do the work in process
+		try:
+			record = cctagutils.server.request([filepath])[0]
+		except (socket.error, ValueError):
+			import cctagutils.index
+			record = cctagutils.index.extract(filepath)
+		if record is None or 'error' in record:
+			# unsupported file type, or one the server could not read;
+			# extracting it again here would fail the same way
+			return attributes
 		
-		attributes['kMDItemRecordingYear'] = meta.getYear()
-		attributes['kMDItemTitle'] = meta.getTitle()
-		attributes['kMDItemAuthors'] = meta.getArtist()
+		attributes['org_creativecommons_license'] = [record['license']]
+		attributes['kMDItemRecordingYear'] = record['year']
+		attributes['kMDItemTitle'] = record['title']
+		attributes['kMDItemAuthors'] = record['authors']
 		
 		return attributes
 		
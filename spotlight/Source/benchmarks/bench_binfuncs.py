@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+bench_binfuncs.py
+
+Compares the per-frame cost of decoding and encoding ID3v2 frame headers
+using the bit list conversions in eyeD3.binfuncs (bytes2bin, bin2dec,
+dec2bin, bin2bytes, bin2synchsafe) with the integer based conversions
+(bytes2int, synchsafe2int, bytes2flags, int2bytes, int2synchsafe,
+flags2bytes), and reports the cost of a complete FrameHeader.parse.
+
+usage: python benchmarks/bench_binfuncs.py [options]
+"""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import os
+import sys
+import optparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SETUP = """
+from StringIO import StringIO
+from eyeD3.binfuncs import bytes2bin, bin2dec, dec2bin, bin2bytes, \
+     bin2synchsafe, bytes2int, synchsafe2int, bytes2flags, int2bytes, \
+     int2synchsafe, flags2bytes
+import eyeD3.frames
+size = '\\x00\\x01\\x23\\x45'
+flags = '\\x00\\x40'
+bits = (0, 1, 2, 8, 9, 10, 14, 4)
+values = (0, 1, 0, 0, 0, 0, 0, 0)
+bitList = [0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+n = 74565
+tagHeader = eyeD3.TagHeader()
+tagHeader.setVersion([2, 3, 0])
+header = eyeD3.frames.FrameHeader(tagHeader)
+frame = StringIO('TIT2' + size + flags)
+"""
+
+# (description, bit list version, integer version)
+CASES = (
+    ('decode size (v2.3)',
+     'bin2dec(bytes2bin(size, 8))',
+     'bytes2int(size)'),
+    ('decode size (v2.4)',
+     'bin2dec(bytes2bin(size, 7))',
+     'synchsafe2int(size)'),
+    ('decode flags',
+     'f = bytes2bin(flags); [f[b] for b in bits]',
+     'bytes2flags(flags, bits)'),
+    ('encode size (v2.3)',
+     'bin2bytes(dec2bin(n, 32))',
+     'int2bytes(n, 4)'),
+    ('encode size (v2.4)',
+     'bin2bytes(bin2synchsafe(dec2bin(n, 32)))',
+     'int2synchsafe(n, 4)'),
+    ('encode flags',
+     'bin2bytes(bitList)',
+     'flags2bytes(values, bits, 2)'),
+    )
+
+def usec(stmt, number, repeat):
+    """Returns the best time of stmt in microseconds per execution."""
+
+    t = timeit.Timer(stmt, SETUP)
+    return min(t.repeat(repeat, number)) / number * 1000000
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--number', type='int', dest='number',
+                      default=20000,
+                      help='executions per timing (default: %default)')
+    parser.add_option('-r', '--repeat', type='int', dest='repeat', default=3,
+                      help='timings per case; the best is reported '
+                      '(default: %default)')
+
+    options, args = parser.parse_args(args)
+
+    print '%-22s %10s %10s %8s' % ('', 'bit lists', 'integers', 'speedup')
+    before = after = 0.0
+    for desc, old, new in CASES:
+        oldTime = usec(old, options.number, options.repeat)
+        newTime = usec(new, options.number, options.repeat)
+        before += oldTime
+        after += newTime
+        print '%-22s %8.2fus %8.2fus %7.1fx' % (desc, oldTime, newTime,
+                                                oldTime / newTime)
+    print '%-22s %8.2fus %8.2fus %7.1fx' % ('total per frame', before, after,
+                                            before / after)
+
+    parse = usec('frame.seek(0); header.parse(frame)', options.number,
+                 options.repeat)
+    print
+    print 'FrameHeader.parse: %.2fus per frame' % parse
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+bench_import.py
+
+Measures the cold start cost of the modules used to read metadata.  Each
+module is imported in a fresh interpreter several times and the fastest
+run is reported; the benchmark fails (exits with a non-zero status) if
+that time exceeds the module's budget, or if the import loads any module
+that is only needed for writing tags or verifying claims.
+
+usage: python benchmarks/bench_import.py [options] [module ...]
+"""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import os
+import sys
+import optparse
+import subprocess
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules benchmarked by default
+MODULES = ('cctagutils.metadata', 'cctagutils.index', 'cctagutils.server')
+
+# modules which must not be loaded just to read metadata
+FORBIDDEN = ('tagger', 'ccrdf', 'rdflib', 'cctagutils.rdf', 'urllib', 'sha',
+             'mimetypes')
+
+# seconds allowed for the import itself, excluding interpreter start up;
+# about twice the time measured for each module, so that losing a good
+# part of the lazy import savings fails the benchmark
+BUDGETS = {'cctagutils.metadata':0.03,
+           'cctagutils.index':0.05,
+           'cctagutils.server':0.015,
+           }
+
+# budget for modules not listed in BUDGETS
+DEFAULT_BUDGET = 0.05
+
+# run in the child interpreter; prints the import time and the names of
+# all loaded modules
+PROBE = """
+import sys, time
+start = time.time()
+__import__(%r)
+sys.stdout.write('%%f\\n' %% (time.time() - start))
+sys.stdout.write(' '.join(sys.modules.keys()) + '\\n')
+"""
+
+def probe(module):
+    """Imports module in a new interpreter; returns the time taken and the
+    set of loaded module names."""
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SOURCE_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    child = subprocess.Popen([sys.executable, '-c', PROBE % module],
+                             stdout=subprocess.PIPE, env=env)
+    output = child.communicate()[0]
+    if child.returncode:
+        raise RuntimeError('importing %s failed' % module)
+
+    elapsed, modules = output.split('\n')[:2]
+    return float(elapsed), set(modules.split())
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] [module ...]')
+    parser.add_option('-n', '--repeat', type='int', dest='repeat', default=5,
+                      help='imports per module (default: %default)')
+    parser.add_option('-b', '--budget', type='float', dest='budget',
+                      default=None,
+                      help='maximum seconds per import (default: per module, '
+                      'or %s)' % DEFAULT_BUDGET)
+
+    options, modules = parser.parse_args(args)
+    modules = modules or MODULES
+
+    failed = 0
+    for module in modules:
+        times = []
+        for i in range(options.repeat):
+            elapsed, loaded = probe(module)
+            times.append(elapsed)
+
+        best = min(times)
+        heavy = [m for m in FORBIDDEN if m in loaded]
+
+        budget = options.budget
+        if budget is None:
+            budget = BUDGETS.get(module, DEFAULT_BUDGET)
+
+        status = 'ok'
+        if best > budget:
+            status = 'OVER BUDGET'
+        if heavy:
+            status = 'LOADS %s' % ', '.join(heavy)
+        if status != 'ok':
+            failed = 1
+
+        print '%-24s %8.1f ms  %4d modules  %s' % (
+            module, best * 1000, len(loaded), status)
+
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+bench_memory.py
+
+Reports the memory held per parsed ID3v2 tag when many tags are kept in
+memory at once, as during a reindex.  A file with a typical tag is linked
+repeatedly and the tags kept; the size of the objects reachable from them
+is totalled with sys.getsizeof, with the objects shared between tags
+counted once, and broken down by type.  On Linux the growth of the
+resident set size is reported too.
+
+usage: python benchmarks/bench_memory.py [options]
+"""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import gc
+import os
+import sys
+import types
+import struct
+import shutil
+import optparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eyeD3
+
+# (frame id, data) of the frames in the tag; ID3 v2.3, latin-1 text
+FRAMES = (
+    ('TIT2', '\x00A Song Title'),
+    ('TPE1', '\x00An Artist'),
+    ('TALB', '\x00An Album Title'),
+    ('TRCK', '\x003/12'),
+    ('TYER', '\x002005'),
+    ('TCON', '\x00(17)'),
+    ('COMM', '\x00eng\x00A comment about the song'),
+    ('TCOP', '\x002005 An Artist. Licensed to the public under '
+             'http://creativecommons.org/licenses/by/2.0/ verify at '
+             'http://example.com/'),
+    ('WCOP', 'http://creativecommons.org/licenses/by/2.0/'),
+    )
+PADDING = 1024
+
+# a 128 kb/s, 44.1 kHz MPEG 1 layer III frame
+AUDIO_FRAME = '\xff\xfb\x90\x00' + '\x55' * 413
+
+# objects shared with the rest of the program, which are not counted
+SHARED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                types.BuiltinFunctionType, types.MethodType)
+
+def synchsafe(n):
+    return ''.join([chr((n >> shift) & 0x7f) for shift in (21, 14, 7, 0)])
+
+def makeFile(path):
+    frames = ''.join([fid + struct.pack('>I', len(data)) + '\x00\x00' + data
+                      for fid, data in FRAMES])
+    fp = open(path, 'wb')
+    fp.write('ID3\x03\x00\x00' + synchsafe(len(frames) + PADDING))
+    fp.write(frames + '\x00' * PADDING)
+    fp.write(AUDIO_FRAME * 10)
+    fp.close()
+
+def typeName(obj):
+    if isinstance(obj, types.InstanceType):
+        return obj.__class__.__name__
+    return type(obj).__name__
+
+def objectSizes(roots):
+    """Returns a dictionary of the total size in bytes of the objects
+    reachable from roots, and their number, by type name."""
+
+    sizes = {}
+    seen = set([id(roots)])
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        name = typeName(obj)
+        size, count = sizes.get(name, (0, 0))
+        sizes[name] = (size + sys.getsizeof(obj), count + 1)
+        stack.extend(gc.get_referents(obj))
+    return sizes
+
+def rss():
+    """Returns the resident set size in bytes, or None if unknown."""
+
+    try:
+        fp = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(fp.read().split()[1])
+    finally:
+        fp.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def linkTags(path, number, lazy):
+    tags = []
+    for i in range(number):
+        tag = eyeD3.Tag()
+        tag.link(path, lazy=lazy)
+        tags.append(tag)
+    return tags
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--number', type='int', dest='number',
+                      default=5000,
+                      help='tags kept in memory (default: %default)')
+    parser.add_option('-l', '--lazy', action='store_true', dest='lazy',
+                      default=False, help='parse the frame bodies lazily')
+
+    options, args = parser.parse_args(args)
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpDir, 'tag.mp3')
+        makeFile(path)
+
+        # parse once first so that anything cached by the first link is not
+        # counted against the tags
+        linkTags(path, 1, options.lazy)
+        gc.collect()
+        before = rss()
+        tags = linkTags(path, options.number, options.lazy)
+        gc.collect()
+        after = rss()
+
+        sizes = objectSizes(tags)
+        total = sum([size for size, count in sizes.values()])
+        byType = [(size, name, count)
+                  for name, (size, count) in sizes.items()]
+        byType.sort()
+        byType.reverse()
+
+        print '%d tags of %d frames, %s parsing' % (
+            options.number, len(FRAMES), options.lazy and 'lazy' or 'eager')
+        print
+        print '%-20s %10s %10s' % ('type', 'bytes/tag', 'objs/tag')
+        for size, name, count in byType:
+            print '%-20s %10.0f %10.1f' % (name, float(size) / options.number,
+                                           float(count) / options.number)
+        print '%-20s %10.0f' % ('total', float(total) / options.number)
+        if before is not None:
+            print '%-20s %10.0f' % ('rss growth',
+                                    float(after - before) / options.number)
+    finally:
+        shutil.rmtree(tmpDir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+bench_sync.py
+
+Compares the cost of finding the first MPEG frame header in files with
+varying amounts of junk between the ID3v2 tag and the audio, using the
+original byte at a time search and the block based eyeD3.mp3.findHeader.
+For each file the time taken and the number of read calls made are
+reported.
+
+usage: python benchmarks/bench_sync.py [options]
+"""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import os
+import sys
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eyeD3.mp3
+from eyeD3.binfuncs import bytes2int
+
+# bytes of junk placed before the audio
+JUNK_SIZES = (0, 1024, 16 * 1024, 256 * 1024, 1024 * 1024)
+
+# a 128 kb/s, 44.1 kHz MPEG 1 layer III frame
+FRAME = '\xff\xfb\x90\x00' + '\x55' * 413
+
+class CountingFile:
+    """Wraps a file object, counting calls to read."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self.fp.read(size)
+
+    def seek(self, offset, whence=0):
+        self.fp.seek(offset, whence)
+
+    def tell(self):
+        return self.fp.tell()
+
+def scanBytewise(f, offset):
+    """The search formerly done by eyeD3.tag.Mp3AudioFile."""
+
+    f.seek(offset)
+    bString = f.read(4)
+    if len(bString) < 4:
+        return None
+    frameHead = bytes2int(bString)
+    header = eyeD3.mp3.Header()
+    while not header.isValid(frameHead):
+        frameHead = (frameHead << 8) & 0xffffffffL
+        bString = f.read(1)
+        if len(bString) != 1:
+            return None
+        frameHead |= ord(bString[0])
+    return f.tell() - 4
+
+def scanBlocks(f, offset):
+    return eyeD3.mp3.findHeader(f, offset)[0]
+
+def makeJunk(size):
+    """Returns size bytes containing no valid frame header, but with the
+    occasional sync byte to be rejected."""
+
+    rand = random.Random(0)
+    junk = [chr(rand.randrange(0xff)) for i in range(min(size, 4096))]
+    for i in range(0, len(junk) - 1, 97):
+        junk[i] = '\xff'
+        junk[i + 1] = '\x00'
+    junk = ''.join(junk)
+    return (junk * (size // 4096 + 1))[:size]
+
+def makeFile(path, junkSize):
+    """Writes a file with a small tag, junkSize bytes of junk and some
+    audio frames; returns the offset the search starts from."""
+
+    tag = 'ID3\x03\x00\x00\x00\x00\x00\x00'
+    fp = open(path, 'wb')
+    fp.write(tag)
+    fp.write(makeJunk(junkSize))
+    fp.write(FRAME * 100)
+    fp.close()
+    return len(tag)
+
+def measure(scan, path, offset, repeat):
+    """Returns the best time taken by scan, the number of reads it made and
+    the offset it found."""
+
+    best = None
+    for i in range(repeat):
+        fp = CountingFile(open(path, 'rb'))
+        start = time.time()
+        found = scan(fp, offset)
+        elapsed = time.time() - start
+        fp.fp.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, fp.reads, found
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', type='int', dest='repeat', default=3,
+                      help='timings per file; the best is reported '
+                      '(default: %default)')
+
+    options, args = parser.parse_args(args)
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        print '%10s %20s %20s %8s' % ('junk', 'byte at a time',
+                                      'blocks', 'speedup')
+        for junkSize in JUNK_SIZES:
+            path = os.path.join(tmpDir, 'junk%d.mp3' % junkSize)
+            offset = makeFile(path, junkSize)
+
+            oldTime, oldReads, oldFound = measure(scanBytewise, path, offset,
+                                                  options.repeat)
+            newTime, newReads, newFound = measure(scanBlocks, path, offset,
+                                                  options.repeat)
+            if oldFound != newFound:
+                print 'results differ for %d bytes of junk: %s, %s' % (
+                    junkSize, oldFound, newFound)
+                return 1
+
+            print '%10d %8.2fms %7d rd %8.2fms %7d rd %7.1fx' % (
+                junkSize, oldTime * 1000, oldReads, newTime * 1000, newReads,
+                oldTime / max(newTime, 1e-6))
+    finally:
+        shutil.rmtree(tmpDir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,8 @@
 # cctagutils Python package
 __id__ = "$Id:"
 
-# bring package modules into the root namespace
-import rdf
-import const
-import lookup
-import metadata
+# package modules are not imported here; importing cctagutils.metadata
+# should not pull in the verification stack (cctagutils.lookup and
+# cctagutils.rdf, which load ccrdf and rdflib), and vice versa.  Import
+# the modules you need explicitly.
 
@@ -0,0 +1,159 @@
+"""Persistent cache of values derived from file contents.
+
+Entries are keyed by file identity -- (device, inode, size, mtime_ns) --
+rather than by name, so a lookup costs a single stat() and any change to
+a file's contents invalidates its entries.  The cache is stored in an
+SQLite database and is bounded to a maximum number of entries per table;
+the least recently used entries are evicted first.
+
+Any picklable value may be stored, including None, so that negative
+results (files with nothing to extract) are remembered too; pass
+default=MISSING to get to tell those apart from misses.  Hits only
+record their use once an entry has drifted towards the eviction end,
+so repeated lookups are read-only."""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import os
+import cPickle as pickle
+import sqlite3
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# writes are batched into transactions of this many statements
+COMMIT_INTERVAL = 1000
+
+# returned by get(..., default=MISSING) when there is no entry
+MISSING = object()
+
+def defaultPath():
+    """Returns the location of the per-user cache database."""
+
+    return os.path.join(os.path.expanduser('~'), '.cctagutils', 'cache.db')
+
+def fileKey(st):
+    """Returns the identity key for the stat result st."""
+
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = long(st.st_mtime * 1000000000)
+
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+class FileCache:
+    """LRU cache of picklable values keyed by file identity.
+
+    Several caches may share one database by using different table
+    names; each table is capped at maxEntries independently.
+
+    version identifies the code producing the values; when a table is
+    opened with a different version than it was last used with, its
+    entries are discarded, so that values computed by an older (perhaps
+    buggy) version are not served for files which have not changed."""
+
+    def __init__(self, path=None, table='metadata',
+                 maxEntries=DEFAULT_MAX_ENTRIES, version=0):
+        if path is None:
+            path = defaultPath()
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        self.path = path
+        self.table = table
+        self.maxEntries = maxEntries
+
+        self.__db = sqlite3.connect(path, timeout=60)
+        self.__db.text_factory = str
+        self.__db.execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+            'used INTEGER, value BLOB, '
+            'PRIMARY KEY (dev, ino, size, mtime_ns))' % table)
+        self.__db.execute('CREATE INDEX IF NOT EXISTS %s_used ON %s (used)' %
+                          (table, table))
+
+        self.__db.execute(
+            'CREATE TABLE IF NOT EXISTS versions ('
+            'name TEXT PRIMARY KEY, version INTEGER)')
+        row = self.__db.execute('SELECT version FROM versions WHERE name=?',
+                                (table,)).fetchone()
+        if row is None or row[0] != version:
+            self.__db.execute('DELETE FROM %s' % table)
+            self.__db.execute('INSERT OR REPLACE INTO versions VALUES (?, ?)',
+                              (table, version))
+        self.__db.commit()
+
+        self.__count, self.__clock = self.__db.execute(
+            'SELECT COUNT(*), MAX(used) FROM %s' % table).fetchone()
+        self.__clock = self.__clock or 0
+        self.__pending = 0
+
+    def __tick(self):
+        self.__clock += 1
+        self.__pending += 1
+        if self.__pending >= COMMIT_INTERVAL:
+            self.commit()
+        return self.__clock
+
+    def get(self, filename, st=None, default=None):
+        """Returns the cached value for filename, or default if the file
+        has not been seen or has changed since it was cached."""
+
+        if st is None:
+            st = os.stat(filename)
+        key = fileKey(st)
+
+        row = self.__db.execute(
+            'SELECT used, value FROM %s WHERE dev=? AND ino=? AND size=? '
+            'AND mtime_ns=?' % self.table, key).fetchone()
+        if row is None:
+            return default
+
+        # only move the entry up once it is in the older half of the
+        # cache; until then it is in no danger of eviction, and skipping
+        # the UPDATE keeps a warm reindex from rewriting every row
+        used, value = row
+        if self.__clock - used > self.maxEntries // 2:
+            self.__db.execute(
+                'UPDATE %s SET used=? WHERE dev=? AND ino=? AND size=? '
+                'AND mtime_ns=?' % self.table, (self.__tick(),) + key)
+        return pickle.loads(str(value))
+
+    def put(self, filename, value, st=None):
+        """Stores value for filename, evicting the least recently used
+        entries if the cache is full."""
+
+        if st is None:
+            st = os.stat(filename)
+        key = fileKey(st)
+
+        self.__db.execute(
+            'INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)' %
+            self.table, key + (self.__tick(),
+                               sqlite3.Binary(pickle.dumps(value, 2))))
+        self.__count += 1
+
+        if self.__count > self.maxEntries:
+            # the count drifts upward on replacements; resync before evicting
+            self.__count = self.__db.execute(
+                'SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+            excess = self.__count - self.maxEntries
+            if excess > 0:
+                self.__db.execute(
+                    'DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s '
+                    'ORDER BY used LIMIT ?)' % (self.table, self.table),
+                    (excess,))
+                self.__count -= excess
+
+    def commit(self):
+        self.__db.commit()
+        self.__pending = 0
+
+    def close(self):
+        if self.__db is not None:
+            self.commit()
+            self.__db.close()
+            self.__db = None
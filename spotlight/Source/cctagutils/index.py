@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+index.py
+
+Headless bulk indexer; walks one or more directory trees and extracts
+the license claim, year, title and authors for every supported audio file
+using a pool of worker processes.  Records are written to stdout as a
+stream of JSON objects, one per line.
+
+usage: python -m cctagutils.index [options] path [path ...]
+"""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import os
+import sys
+import collections
+import multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import cctagutils.cli as cli
+import cctagutils.cache
+from cctagutils.metadata import metadata, meta_handlers
+from cctagutils.lookup import parseClaim
+
+NOT_LICENSED = '(not licensed)'
+
+# version of the records produced by extract; increased whenever their
+# contents change (including by bug fixes, such as reading the wrong
+# artist frame), so that records cached by older versions are discarded
+EXTRACTOR_VERSION = 2
+
+# number of files handed to a worker at a time; large enough to amortize
+# the inter-process round trip, small enough to keep all workers busy
+# near the end of a run
+DEFAULT_CHUNKSIZE = 64
+
+# extensions of files commonly found alongside audio which are never
+# audio themselves, and so are not opened
+SKIP_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'bmp', 'txt', 'nfo', 'cue',
+                   'log', 'm3u', 'pls', 'pdf', 'ini', 'db', 'ds_store')
+
+def isIndexable(filename):
+    """Returns True if filename may be an audio file.  Files are identified
+    by their contents (see cctagutils.metadata.metadata), so a file with
+    no extension or an unknown one is indexable, and only extensions of
+    known non-audio types are excluded."""
+
+    if '.' not in filename:
+        return True
+    ext = filename.split('.')[-1].lower()
+    return ext in meta_handlers or ext not in SKIP_EXTENSIONS
+
+def walk(paths):
+    """Generates the indexable files (see isIndexable) contained in paths;
+    each item in paths may be either a file or a directory to be searched
+    recursively.  Files which turn out not to be audio yield no record
+    from extract."""
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            filenames.sort()
+            for f in filenames:
+                if isIndexable(f):
+                    yield os.path.join(dirpath, f)
+
+def extractCache(path=None, maxEntries=cctagutils.cache.DEFAULT_MAX_ENTRIES):
+    """Returns a cctagutils.cache.FileCache for the records produced by
+    extract, stored in the database at path (by default the per-user
+    cache)."""
+
+    return cctagutils.cache.FileCache(path, maxEntries=maxEntries,
+                                      version=EXTRACTOR_VERSION)
+
+def extract(filename, cache=None):
+    """Returns a dictionary containing the attributes the Spotlight importer
+    records for filename: license, year, title and authors.  Returns None
+    if the file type is not supported.
+
+    If cache (see extractCache) is supplied it is consulted
+    before the file is opened, and updated on a miss; unsupported files
+    are cached too, so that they are not reopened on the next run."""
+
+    if cache is not None:
+        st = os.stat(filename)
+        record = cache.get(filename, st, default=cctagutils.cache.MISSING)
+        if record is not cctagutils.cache.MISSING:
+            if record is not None:
+                record['filename'] = filename
+            return record
+
+        record = extract(filename)
+        cache.put(filename, record, st)
+        return record
+
+    try:
+        meta = metadata(filename)
+
+        claim = meta.getClaim()
+        if claim:
+            license = parseClaim(claim).get('license', NOT_LICENSED)
+        else:
+            license = NOT_LICENSED
+
+        return {'filename':filename,
+                'license':license,
+                'year':meta.getYear(),
+                'title':meta.getTitle(),
+                'authors':meta.getArtist(),
+                }
+    except NotImplementedError:
+        return None
+
+def _extract(filename, cache=None):
+    """Pool entry point; exceptions are returned as part of the record
+    so that one bad file does not abort the entire run."""
+
+    try:
+        return extract(filename, cache)
+    except Exception, e:
+        return {'filename':filename, 'error':'%s: %s' % (
+            e.__class__.__name__, e)}
+
+def _extractMany(filenames):
+    return [_extract(f) for f in filenames]
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def index(paths, workers=None, chunksize=DEFAULT_CHUNKSIZE, cache=None):
+    """Generates a record for every indexable file in paths.  Extraction
+    is distributed across [workers] processes; by default one per CPU.
+
+    If cache is supplied, files are looked up in the parent process and
+    only files which are new or have changed are handed to the workers."""
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if workers < 2:
+        for filename in walk(paths):
+            record = _extract(filename, cache)
+            if record is not None:
+                yield record
+        return
+
+    pool = multiprocessing.Pool(workers)
+    # bound the amount of outstanding work so the walk never runs far
+    # ahead of the workers
+    pending = collections.deque()
+    maxPending = workers * 4
+    try:
+        for chunk in _chunks(walk(paths), chunksize):
+            misses = []
+            for filename in chunk:
+                if cache is None:
+                    misses.append((filename, None))
+                    continue
+
+                try:
+                    st = os.stat(filename)
+                except OSError, e:
+                    yield {'filename':filename, 'error':str(e)}
+                    continue
+
+                record = cache.get(filename, st,
+                                   default=cctagutils.cache.MISSING)
+                if record is cctagutils.cache.MISSING:
+                    misses.append((filename, st))
+                elif record is not None:
+                    record['filename'] = filename
+                    yield record
+
+            if misses:
+                pending.append((misses, pool.apply_async(
+                    _extractMany, ([f for f, st in misses],))))
+
+            while pending and (len(pending) > maxPending or
+                               pending[0][1].ready()):
+                for record in _collect(pending.popleft(), cache):
+                    yield record
+
+        while pending:
+            for record in _collect(pending.popleft(), cache):
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _collect(entry, cache):
+    """Yields the records of a completed chunk, storing them in cache."""
+
+    misses, result = entry
+    for (filename, st), record in zip(misses, result.get()):
+        if cache is not None and (record is None or 'error' not in record):
+            cache.put(filename, record, st)
+        if record is not None:
+            yield record
+
+def main(args=None):
+    parser = cli.OptionParser(usage='%prog [options] path [path ...]',
+                              option_class=cli.Option)
+    parser.add_option('-j', '--workers', type='int', dest='workers',
+                      default=None,
+                      help='number of worker processes (default: one per CPU)')
+    parser.add_option('--chunksize', type='int', dest='chunksize',
+                      default=DEFAULT_CHUNKSIZE,
+                      help='files handed to a worker at a time')
+    parser.add_option('--cache', dest='cache',
+                      default=cctagutils.cache.defaultPath(),
+                      help='extraction cache database (default: %default)')
+    parser.add_option('--no-cache', action='store_const', const=None,
+                      dest='cache', help='do not use the extraction cache')
+    parser.add_option('--cache-size', type='int', dest='cacheSize',
+                      default=cctagutils.cache.DEFAULT_MAX_ENTRIES,
+                      help='maximum number of cached files')
+
+    options, paths = parser.parse_args(args)
+    if not paths:
+        parser.error('no paths specified')
+
+    cache = None
+    if options.cache:
+        cache = extractCache(options.cache, options.cacheSize)
+
+    errors = 0
+    try:
+        for record in index(paths, options.workers, options.chunksize,
+                            cache):
+            if 'error' in record:
+                errors += 1
+                sys.stderr.write('%s: %s\n' % (record['filename'],
+                                               record['error']))
+                continue
+
+            sys.stdout.write(json.dumps(record) + '\n')
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return errors and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
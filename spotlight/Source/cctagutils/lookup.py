@@ -5,11 +5,8 @@ __version__ = "$Revision$"
 __copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
 __license__ = 'licensed under the GNU GPL2'
 
-import ccrdf
-import ccrdf.rdfextract as rdfextract
-
-import cctagutils.rdf
-from cctagutils.metadata import metadata
+# the RDF and tag reading libraries are only needed for verification
+# and are imported by verify()
 
 def parseClaim(claim):
     results = {}
@@ -47,6 +44,12 @@ def verify(filename):
     -2    Verification license does not match claim.
     """
 
+    import ccrdf
+    import ccrdf.rdfextract as rdfextract
+
+    import cctagutils.rdf
+    from cctagutils.metadata import metadata
+
     status = 0
     
     claim = metadata(filename).getClaim()
@@ -54,7 +57,10 @@ def verify(filename):
         raise cctag.exceptions.NotLicensedException
     
     fileinfo = parseClaim(claim)
-    fileinfo['sha'] = 'urn:sha1:%s' % cctag.rdf.fileHash(filename)
+    # the work may be identified by the hash of the whole file or of its
+    # audio payload (see cctagutils.rdf.generate)
+    subjects = ('urn:sha1:%s' % cctagutils.rdf.fileHash(filename),
+                'urn:sha1:%s' % cctagutils.rdf.payloadHash(filename))
 
     verifyRdf = rdfextract.RdfExtractor().extractRdfText(
         rdfextract.retrieveUrl(fileinfo['verify at'])
@@ -75,7 +81,7 @@ def verify(filename):
         for work in verifyCc.works():
             
             # if the subject matches...
-            if work.subject == fileinfo['sha']:
+            if work.subject in subjects:
                 # we found the work information;
                 # only one reason left to not verify
                 status = -2
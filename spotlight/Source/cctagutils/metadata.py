@@ -8,16 +8,21 @@ __version__ = "$Revision$"
 __copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
 __license__ = 'licensed under the GNU GPL2'
 
-# use the bundled version of PyTagger, which contains our fixes.
-import tagger
+# eyeD3 is used to read tags; the bundled version of PyTagger (which
+# contains our fixes) is only needed to upgrade v2.2 tags and is imported
+# when that happens.
 import eyeD3
 import os
 import cctagutils.const as const
 
 class AudioMetadata:
-    def __init__(self, filename):
+    def __init__(self, filename, fileobj=None):
         self.filename = filename
 
+        # handlers which make use of an already open file override this
+        if fileobj is not None:
+            fileobj.close()
+
     def getTitle(self):
         raise NotImplementedError()
 
@@ -30,11 +35,13 @@ class AudioMetadata:
     def getClaim(self):
         raise NotImplementedError()
 
-    def setClaim(self, claim):
+    def setClaim(self, claim, hashCache=None):
         raise NotImplementedError()
     
-    def embed(self, license, verification, year, holder):
-        """Embed a license claim in the audio file."""
+    def embed(self, license, verification, year, holder, hashCache=None):
+        """Embed a license claim in the audio file.  If hashCache (see
+        cctagutils.rdf.hashCache) is a payload hash cache, the file's cached
+        payload hash is kept valid across the change."""
         raise NotImplementedError()
 
     def isWritable(self):
@@ -42,18 +49,33 @@ class AudioMetadata:
         raise NotImplementedError()
     
 class Mp3Metadata(AudioMetadata):
-    def __init__(self, filename):
+    # the only frames read by the accessors; v2.2 equivalents are mapped
+    # to these by eyeD3.  Tuples are alternatives in the order the
+    # accessors prefer them; reading stops early only once the first of
+    # each has been found, since frames may be in any order in the tag.
+    READ_FRAMES = ('TIT2', ('TPE1', 'TPE2', 'TPE3', 'TPE4', 'TCOM'),
+                   ('TYER', 'TDRC'), 'TCOP')
+
+    def __init__(self, filename, fileobj=None):
         AudioMetadata.__init__(self, filename)
-        self.__open(filename)
+        self.__open(filename, self.READ_FRAMES, fileobj)
 
-    def __open(self, filename=None):
+    def __open(self, filename=None, frameIds=None, fileobj=None):
         if filename is not None:
             self.filename = str(filename)
 
-        # create a handle for ID3v2
+        # create a handle for ID3v2; frame bodies are only decoded when
+        # they're accessed, and if frameIds is specified all other frames
+        # are skipped without being read
         self.__tag = eyeD3.Tag()
         try:
-            self.__tag.link(self.filename)
+            if fileobj is None:
+                self.__tag.link(self.filename, lazy=1, frameIds=frameIds)
+            else:
+                try:
+                    self.__tag.link(fileobj, lazy=1, frameIds=frameIds)
+                finally:
+                    fileobj.close()
         except eyeD3.tag.TagException, e:
             if "2.2" in e.msg:
                 print 'aieee!'
@@ -68,9 +90,12 @@ class Mp3Metadata(AudioMetadata):
         if self.__tag is None:
             return None
 
-        for frame in self.__tag.frames:
-            if frame.header.id in fids:
-                return frame
+        # look frames up by ID rather than iterating, so that only the
+        # frame returned is decoded
+        for fid in fids:
+            frames = self.__tag.frames[fid]
+            if frames:
+                return frames[0]
 
         return None
 
@@ -116,6 +141,8 @@ class Mp3Metadata(AudioMetadata):
     def upgrade(self):
         """Upgrades a file's ID3 tags from ID3v2.2 to ID3v2.3."""
 
+        import tagger
+
         # open the file using tagger
         self.__v2 = tagger.id3v2.ID3v2(self.filename,
                                        tagger.constants.ID3_FILE_MODIFY)
@@ -155,6 +182,8 @@ class Mp3Metadata(AudioMetadata):
         if self.__hasV1:
             return
 
+        import tagger
+
         self.__v1.songname = self.getTitle()
         self.__v1.artist = self.getArtist()
         self.__v1.year = self.getYear()
@@ -173,12 +202,23 @@ class Mp3Metadata(AudioMetadata):
             if f.header.id == 'TCOP':
                del f
 
-    def setClaim(self, claim):
+    def setClaim(self, claim, hashCache=None):
+
+        # Tag.update only rewrites the tags, so a cached payload hash still
+        # holds for the file afterwards
+        if hashCache is not None:
+            oldStat = os.stat(self.filename)
+        upgraded = False
+
+        # the tag was read with only the frames the accessors need; load
+        # all of it before deciding how to rewrite the file
+        self.__open()
 
         # check if an upgrade to 2.3 is needed before embedding
         if (self._needsUpgrade()):
             # update tags to ID3v2.3
             self.upgrade()
+            upgraded = True
 
         # reopen the file (in case of 2.2)
         self.__open()
@@ -194,13 +234,19 @@ class Mp3Metadata(AudioMetadata):
         self.__tag.frames.append(tcop)
         self.__tag.update()
 
-    def embed(self, license, verification, year, holder):
+        # the upgrade goes through PyTagger, which does not guarantee to
+        # leave the bytes after the tag as they were
+        if hashCache is not None and not upgraded:
+            import cctagutils.rdf
+            cctagutils.rdf.copyPayloadHash(self.filename, oldStat, hashCache)
+
+    def embed(self, license, verification, year, holder, hashCache=None):
         
         # first generate the embedded license claim str
         claim = "%s %s. Licensed to the public under %s verify at %s" % (
             year, holder, license, verification )
 
-        self.setClaim(claim)
+        self.setClaim(claim, hashCache)
         
         # add ID3v1 if necessary
         # self._addId3v1()
@@ -215,19 +261,56 @@ class OggMetadata(AudioMetadata):
 meta_handlers = {'mp3':Mp3Metadata,
                  'ogg':OggMetadata,
                  }
-                
+
+# number of leading bytes examined to identify a file; they are read as
+# part of an eyeD3.utils.WindowFile, which is then given to the handler so
+# that the file is opened only once
+SNIFF_SIZE = eyeD3.tag.SNIFF_SIZE
+
+def sniff(head):
+    """Returns the name of the format identified by the leading bytes of a
+    file ('mp3', 'ogg', 'flac', 'wav' or 'mp4'), or None if the format is
+    not recognized."""
+
+    if eyeD3.tag.isMp3Data(head):
+        return 'mp3'
+    if head[:4] == 'OggS':
+        return 'ogg'
+    if head[:4] == 'fLaC':
+        return 'flac'
+    if head[:4] == 'RIFF' and head[8:12] == 'WAVE':
+        return 'wav'
+    if head[4:8] == 'ftyp':
+        return 'mp4'
+    return None
+
 def metadata(filename):
     """Returns the appropriate instance for the detected filetype of
     [filename].  The returned instance will be a subclass of the
-    AudioMetadata class."""
-
-    # XXX right now we do stupid name-based type detection; a future
-    # improvment might actually look at the file's contents.
-    ext = filename.split('.')[-1].lower()
-    if ext in meta_handlers:
-        return meta_handlers[ext](filename)
+    AudioMetadata class.
+
+    The type is detected from the file's contents; the extension is
+    only used if the contents are not recognized."""
+
+    try:
+        fp = eyeD3.utils.WindowFile(filename)
+    except (IOError, OSError):
+        fp = None
+
+    format = None
+    if fp is not None:
+        format = sniff(fp.head[:SNIFF_SIZE])
+    if format is None:
+        format = filename.split('.')[-1].lower()
+
+    if format in meta_handlers:
+        if fp is None:
+            return meta_handlers[format](filename)
+        return meta_handlers[format](filename, fp)
     else:
+        if fp is not None:
+            fp.close()
+
         # fall back to AudioMetadata, which will raise NotImplementedErrors
         # as necessary
         return AudioMetadata(filename)
-
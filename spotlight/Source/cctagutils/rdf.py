@@ -6,17 +6,17 @@ __version__ = "$Revision$"
 __copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
 __license__ = 'licensed under the GNU GPL2'
 
+import os
 import re
-import urllib
 import cctagutils.base32 as base32
-import sha
-from cctagutils.metadata import metadata
 
 def getLicense(license_url):
 	"""Extract license RDF from a given url; if an error occurs
 	in retrieving the url, return None.
 	"""
 	
+	import urllib
+
 	lre = re.compile("<License.*?</License>", re.DOTALL)
 	try:
 		license_doc = urllib.urlopen(license_url).read()
@@ -25,11 +25,162 @@ def getLicense(license_url):
 		return None
 	
 
-def fileHash(filename):
-    return base32.b2a(sha.new(file(filename, 'rb').read()).digest()).upper()
+# files are hashed in blocks of this many bytes
+HASH_BLOCKSIZE = 1024 * 1024
+
+# names of the cctagutils.cache tables holding file and payload hashes
+HASH_CACHE_TABLE = 'sha1'
+PAYLOAD_HASH_CACHE_TABLE = 'payload_sha1'
+
+# size of an APE tag header or footer
+APE_FOOTER_SIZE = 32
+
+def hashCache(path=None, payload=False):
+    """Returns a cctagutils.cache.FileCache for file hashes (or payload
+    hashes, if payload is True), stored in the database at path (by
+    default the per-user cache)."""
+
+    import cctagutils.cache
+    if payload:
+        table = PAYLOAD_HASH_CACHE_TABLE
+    else:
+        table = HASH_CACHE_TABLE
+    return cctagutils.cache.FileCache(path, table=table)
+
+def _hashRange(f, start, end):
+    """Returns the base32 encoded SHA-1 digest of bytes [start, end) of the
+    open file f, reading it in blocks."""
+
+    import sha
+    h = sha.new()
+    f.seek(start)
+    left = end - start
+    while left > 0:
+        block = f.read(min(left, HASH_BLOCKSIZE))
+        if not block:
+            break
+        h.update(block)
+        left -= len(block)
+
+    return base32.b2a(h.digest()).upper()
+
+def fileHash(filename, cache=None):
+    """Returns the base32 encoded SHA-1 digest of the contents of filename.
+    The file is read in blocks, so memory use does not depend on its size.
+
+    If cache (see hashCache) is supplied, the digest of a file which has
+    not changed since it was last hashed is taken from it."""
+
+    if cache is not None:
+        st = os.stat(filename)
+        digest = cache.get(filename, st)
+        if digest is None:
+            digest = fileHash(filename)
+            cache.put(filename, digest, st)
+        return digest
+
+    f = file(filename, 'rb')
+    try:
+        return _hashRange(f, 0, os.fstat(f.fileno()).st_size)
+    finally:
+        f.close()
+
+def payloadRange(filename):
+    """Returns the (start, end) offsets of the audio payload of filename;
+    that is, the file less any leading ID3v2 tag (including its padding
+    and footer) and any trailing ID3v1 and APE tags."""
+
+    import eyeD3.utils
+
+    f = eyeD3.utils.WindowFile(filename)
+    try:
+        return _payloadRange(f)
+    finally:
+        f.close()
+
+def _payloadRange(f):
+    """payloadRange for an open eyeD3.utils.WindowFile; the tags are read
+    from its head and tail windows."""
+
+    import struct
+    import eyeD3
+
+    # only the tag header is needed; no frames are read
+    start = 0
+    tag = eyeD3.Tag()
+    if tag.link(f, eyeD3.ID3_V2, frameIds=()):
+        start = tag.header.SIZE + tag.linkedFile.tagSize
+        if tag.header.footer:
+            start += tag.header.SIZE
+
+    end = f.size
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == 'TAG':
+            end -= 128
+
+    if end - start >= APE_FOOTER_SIZE:
+        f.seek(end - APE_FOOTER_SIZE)
+        footer = f.read(APE_FOOTER_SIZE)
+        if footer[:8] == 'APETAGEX':
+            # the size includes the footer but not the optional header
+            version, size, items, flags = struct.unpack(
+                '<4L', footer[8:24])
+            if flags & 0x80000000L:
+                size += APE_FOOTER_SIZE
+            end = max(start, end - size)
+
+    return start, end
+
+def payloadHash(filename, cache=None):
+    """Returns the base32 encoded SHA-1 digest of the audio payload of
+    filename (see payloadRange).  Unlike fileHash, the digest does not
+    change when the file's tags are edited.
+
+    If cache (see hashCache) is supplied, the digest of a file which has
+    not changed since it was last hashed is taken from it.  Writers which
+    only change a file's tags can carry its digest over to the retagged
+    file with copyPayloadHash."""
+
+    import eyeD3.utils
+
+    # the file is opened once, both to find the payload and to hash it
+    f = eyeD3.utils.WindowFile(filename)
+    try:
+        start, end = _payloadRange(f)
+        if cache is None:
+            return _hashRange(f, start, end)
+
+        st = os.fstat(f.fileno())
+        digest = cache.get(filename, st)
+        if digest is None:
+            digest = _hashRange(f, start, end)
+            cache.put(filename, digest, st)
+        return digest
+    finally:
+        f.close()
+
+def copyPayloadHash(filename, oldStat, cache):
+    """Stores the payload digest cached for filename as it was before being
+    retagged (oldStat is its stat result from then) under its current
+    identity, so that the retag does not cause it to be hashed again.
+    Only tags may have been changed; the payload must be as it was."""
+
+    digest = cache.get(filename, oldStat)
+    if digest is not None:
+        cache.put(filename, digest)
 
 def generate(files, claim_url, license, year, holder,
-	     source=None, license_rdf=None, work_meta={} ):
+	     source=None, license_rdf=None, work_meta={}, hash_cache=None,
+	     payload_hash=False ):
+	"""Returns the verification RDF for files.  If hash_cache is
+	supplied it is used to avoid re-reading files which have not
+	changed since they were last hashed.
+
+	If payload_hash is True works are identified by the hash of their
+	audio payload (see payloadHash), which survives retagging, rather
+	than of the entire file; hash_cache should then be a payload hash
+	cache."""
 
 	if not(license_rdf):
 		# attempt to retrieve the rdf
@@ -42,7 +193,10 @@ def generate(files, claim_url, license, year, holder,
   xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n"""
 	
 	for f in files:
-                h = fileHash(f)
+		if payload_hash:
+			h = payloadHash(f, hash_cache)
+		else:
+			h = fileHash(f, hash_cache)
 
 		out += '<Work rdf:about="urn:sha1:'+h+'">\n'
 
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+server.py
+
+Resident metadata extraction server.  Listens on a Unix domain socket and
+extracts records (see cctagutils.index.extract) for batches of paths
+using a pool of worker processes, so that clients pay neither interpreter
+start up nor the cost of importing the tagging libraries.
+
+The protocol is line oriented; each request is a JSON object of the form
+
+    {"paths": ["/path/one.mp3", "/path/two.mp3"]}
+
+followed by a newline, and is answered with a single line
+
+    {"records": [{...}, null]}
+
+containing one record per path, in order (null for unsupported files).
+Any number of requests may be sent over a connection.  A request which
+can not be answered, including one which takes the workers longer than
+EXTRACT_TIMEOUT, is answered with {"error": "..."} instead.
+
+usage: python -m cctagutils.server [options]
+"""
+
+__id__ = "$Id$"
+__version__ = "$Revision$"
+__copyright__ = '(c) 2004, Creative Commons, Nathan R. Yergler'
+__license__ = 'licensed under the GNU GPL2'
+
+import os
+import sys
+import signal
+import socket
+import SocketServer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# the extraction machinery is imported by the server only; clients
+# should be as cheap to load as possible
+
+# seconds a client waits for the server to accept, read or answer a
+# request before giving up on it
+DEFAULT_TIMEOUT = 5.0
+
+# seconds the server waits for its workers to complete a request; less
+# than DEFAULT_TIMEOUT so that clients are told about the failure
+EXTRACT_TIMEOUT = 4.0
+
+class ExtractionError(Exception):
+    """Raised when the workers fail to complete a request."""
+
+def defaultAddress():
+    """Returns the location of the per-user server socket."""
+
+    return os.path.join(os.path.expanduser('~'), '.cctagutils', 'server.sock')
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            try:
+                paths = json.loads(line)['paths']
+                response = {'records':self.server.extract(paths)}
+            except (ValueError, KeyError, TypeError), e:
+                response = {'error':'invalid request: %s' % e}
+            except ExtractionError, e:
+                response = {'error':'extraction failed: %s' % e}
+
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+class ExtractionServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    """Serves extraction requests; each connection is handled in its own
+    thread, while the extraction itself is done by [workers] processes
+    (by default one per CPU).  If the workers do not complete a request
+    within timeout seconds, or fail, the pool is replaced so that a
+    worker which has died or hung does not hold up later requests."""
+
+    daemon_threads = True
+
+    def __init__(self, address=None, workers=None, timeout=EXTRACT_TIMEOUT):
+        import threading
+        import cctagutils.index
+
+        if address is None:
+            address = defaultAddress()
+        if os.path.dirname(address) and \
+               not os.path.isdir(os.path.dirname(address)):
+            os.makedirs(os.path.dirname(address))
+
+        # a socket left behind by a server which has exited can be reused
+        if os.path.exists(address):
+            try:
+                connect(address, DEFAULT_TIMEOUT).close()
+            except socket.error:
+                os.unlink(address)
+            else:
+                raise socket.error('a server is already listening on %s' %
+                                   address)
+
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.timeout = timeout
+        self.__extract = cctagutils.index._extract
+
+        self.pool = None
+        self.__poolLock = threading.Lock()
+        if workers > 1:
+            self.pool = self.__newPool()
+
+        SocketServer.UnixStreamServer.__init__(self, address, RequestHandler)
+
+    def __newPool(self):
+        import multiprocessing
+        return multiprocessing.Pool(self.workers, _initWorker)
+
+    def __replacePool(self, pool):
+        """Terminates pool and starts a new one in its place, unless
+        another thread has already done so."""
+
+        self.__poolLock.acquire()
+        try:
+            if self.pool is pool:
+                self.pool = self.__newPool()
+        finally:
+            self.__poolLock.release()
+        _terminatePool(pool, 0)
+
+    def extract(self, paths):
+        """Returns a list containing the record for each item in paths.
+        Raises ExtractionError if the workers fail to produce them."""
+
+        paths = [str(p) for p in paths]
+        pool = self.pool
+        if pool is None or len(paths) < 2:
+            return [self.__extract(p) for p in paths]
+
+        import multiprocessing
+
+        chunksize = max(1, len(paths) // (self.workers * 4))
+        try:
+            return pool.map_async(self.__extract, paths,
+                                  chunksize).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            # the results of a worker which has hung or died never arrive,
+            # so the pool can not be relied on for further requests
+            self.__replacePool(pool)
+            raise ExtractionError('timed out after %g seconds' %
+                                  self.timeout)
+        except Exception, e:
+            self.__replacePool(pool)
+            raise ExtractionError('%s: %s' % (e.__class__.__name__, e))
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+        if self.pool is not None:
+            _terminatePool(self.pool, self.timeout)
+            self.pool = None
+
+def _terminatePool(pool, timeout):
+    """Terminates pool, waiting at most timeout seconds for it to finish.
+    Pool.terminate blocks forever if a worker was killed while holding
+    the lock on the task queue, so it is run in a daemon thread; any
+    workers it leaves behind are stopped when the server exits."""
+
+    import threading
+    thread = threading.Thread(target=pool.terminate)
+    thread.setDaemon(True)
+    thread.start()
+    thread.join(timeout)
+
+def _initWorker():
+    # workers are forked after the server's SIGTERM handler is installed;
+    # they are stopped by the pool with SIGTERM and should simply exit
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def connect(address=None, timeout=None):
+    """Returns a socket connected to the server at address.  If timeout is
+    given, operations on the socket raise socket.timeout after that many
+    seconds."""
+
+    if address is None:
+        address = defaultAddress()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+def request(paths, address=None, timeout=DEFAULT_TIMEOUT):
+    """Asks the server listening at address to extract the records for
+    paths and returns them as a list, in the same order.  Raises
+    socket.error if no server is listening, or socket.timeout (a
+    subclass) if the server does not answer within timeout seconds of
+    each step, so that callers fall back to extracting in process rather
+    than waiting on a stuck server."""
+
+    sock = connect(address, timeout)
+    try:
+        sock.sendall(json.dumps({'paths':list(paths)}) + '\n')
+        response = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    if not response:
+        raise socket.error('connection closed by server')
+
+    response = json.loads(response)
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response['records']
+
+def main(args=None):
+    import cctagutils.cli as cli
+
+    parser = cli.OptionParser(usage='%prog [options]',
+                              option_class=cli.Option)
+    parser.add_option('-s', '--socket', dest='address',
+                      default=defaultAddress(),
+                      help='socket to listen on (default: %default)')
+    parser.add_option('-j', '--workers', type='int', dest='workers',
+                      default=None,
+                      help='number of worker processes (default: one per CPU)')
+
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error('unexpected arguments')
+
+    # make sure the socket and worker pool are cleaned up on termination;
+    # the handler is installed before the workers are started so that a
+    # SIGTERM arriving at any point is handled
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = ExtractionServer(options.address, options.workers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -18,6 +18,7 @@
 #  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 ################################################################################
+import struct;
 
 # Accepts a string of bytes (chars) and returns an array of bits
 # representing the bytes in big endian byte (Most significant byte/bit first)
@@ -127,3 +128,87 @@ def bin2synchsafe(x):
       bits = ([0] * (32 - len(x))) + bits;
 
    return bits;
+
+################################################################################
+# The functions below work on strings of bytes and integers directly rather
+# than going through lists of bits, and are the ones used for parsing and
+# rendering.  The bit list functions above are kept for compatibility.
+
+# Accepts a string of bytes and returns its value as a big endian unsigned
+# integer.
+def bytes2int(bytes):
+   n = len(bytes);
+   if n == 4:
+      return struct.unpack(">L", bytes)[0];
+   elif n == 2:
+      return struct.unpack(">H", bytes)[0];
+   elif n == 1:
+      return ord(bytes);
+
+   value = 0;
+   for b in bytes:
+      value = (value << 8) | ord(b);
+   return value;
+
+# Converts a non-negative integer to a big endian string of (at least) sz bytes.
+def int2bytes(n, sz = 4):
+   if sz == 4 and n >= 0 and n <= 0xffffffffL:
+      return struct.pack(">L", n);
+   elif sz == 1 and n >= 0 and n <= 0xff:
+      return chr(n);
+
+   out = [];
+   while n > 0 or len(out) < sz:
+      out.append(chr(n & 0xff));
+      n >>= 8;
+   out.reverse();
+   return "".join(out);
+
+# Accepts a string of bytes holding a synch safe integer (section 6.2 of the
+# ID3 2.4 spec), where only the low 7 bits of each byte are used, and returns
+# its value.
+def synchsafe2int(bytes):
+   if len(bytes) == 4:
+      n = struct.unpack(">L", bytes)[0];
+      return ((n & 0x7f000000) >> 3) | ((n & 0x007f0000) >> 2) |\
+             ((n & 0x00007f00) >> 1) | (n & 0x0000007f);
+
+   value = 0;
+   for b in bytes:
+      value = (value << 7) | (ord(b) & 0x7f);
+   return value;
+
+# Converts an integer to a synch safe string of sz bytes.  A ValueError is
+# raised when the value does not fit.
+def int2synchsafe(n, sz = 4):
+   if n < 0 or n >= (1L << (7 * sz)):
+      raise ValueError("Invalid value");
+
+   if sz == 4:
+      return struct.pack(">L", ((n & 0x0fe00000) << 3) |
+                               ((n & 0x001fc000) << 2) |
+                               ((n & 0x00003f80) << 1) | (n & 0x7f));
+   out = [];
+   for i in range(sz):
+      out.append(chr(n & 0x7f));
+      n >>= 7;
+   out.reverse();
+   return "".join(out);
+
+# Flag bits are numbered from the most significant bit of the first byte, as
+# in the lists returned by bytes2bin.  Returns a list with the value (0 or 1)
+# of each bit in positions.
+def bytes2flags(bytes, positions):
+   n = bytes2int(bytes);
+   top = len(bytes) * 8 - 1;
+   return [(n >> (top - p)) & 1 for p in positions];
+
+# The inverse of bytes2flags; returns sz bytes with the bit at each of
+# positions set if the corresponding value is true.
+def flags2bytes(values, positions, sz = 1):
+   n = 0;
+   top = sz * 8 - 1;
+   for i in range(len(positions)):
+      if values[i]:
+         n |= 1 << (top - positions[i]);
+   return int2bytes(n, sz);
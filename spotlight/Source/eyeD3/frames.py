@@ -18,8 +18,9 @@
 #  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 ################################################################################
-import sys, os, os.path, re, zlib, StringIO, time, mimetypes;
+import sys, os, os.path, re, zlib, StringIO, time;
 from StringIO import StringIO;
+import utils;
 from utils import *;
 from binfuncs import *;
 
@@ -265,6 +266,9 @@ IMAGE_FRAME_RX = re.compile("^" + IMAGE_FID + "$");
 PLAYCOUNT_FRAME_RX = re.compile("^" + PLAYCOUNT_FID + "$");
 UNIQUE_FILE_ID_FRAME_RX = re.compile("^" + UNIQUE_FILE_ID_FID + "$");
 
+FRAME_ID_RX = re.compile("^[A-Z0-9][A-Z0-9][A-Z0-9][A-Z0-9]$");
+LANG_RX = re.compile("[A-Z][A-Z][A-Z]", re.IGNORECASE);
+
 # MP3ext causes illegal frames to be inserted, which must be ignored.
 # Copied from http://shell.lab49.com/~vivake/python/MP3Info.py
 # Henning Kiel <henning.kiel@rwth-aachen.de>
@@ -312,40 +316,74 @@ class FrameException(Exception):
     pass;
 
 ################################################################################
-class FrameHeader:
+# Returns a property for the frame header flag stored in the bit mask of the
+# header's flags, which reads as 0 or 1.
+def flagProperty(mask):
+   def get(self):
+      return (self.flags & mask) and 1 or 0;
+   def set(self, value):
+      if value:
+         self.flags |= mask;
+      else:
+         self.flags &= ~mask;
+   return property(get, set);
+
+# Frame headers use __slots__, and keep all eight flags in one integer, since
+# a tag holds one per frame and a dictionary per header used to cost more than
+# most frames' data.  (Frames themselves keep their dictionaries, as
+# LazyFrame.decode changes the class of a frame in place.)
+class FrameHeader(object):
    FRAME_HEADER_SIZE = 10;
-   # The tag header
-   majorVersion = DEFAULT_ID3_MAJOR_VERSION;
-   minorVersion = DEFAULT_ID3_MINOR_VERSION;
-   # The 4 character frame ID.
-   id = None;
-   # An array of 16 "bits"...
-   flags = NULL_FRAME_FLAGS;
-   # ...and the info they store.
-   tagAlter = 0;
-   fileAlter = 0;
-   readOnly = 0;
-   compressed = 0;
-   encrypted = 0;
-   grouped = 0;
-   unsync = 0;
-   dataLenIndicator = 0;
-   # The size of the data following this header.
-   dataSize = 0;
-
-   # 2.4 not only added flag bits, but also reordered the previously defined
-   # flags.  So these are mapped once we know the version.
-   TAG_ALTER   = None;   
-   FILE_ALTER  = None;   
-   READ_ONLY   = None;   
-   COMPRESSION = None;   
-   ENCRYPTION  = None;   
-   GROUPING    = None;   
-   UNSYNC      = None;   
-   DATA_LEN    = None;   
+   # v2.2 frame headers have a 3 byte ID and size, and no flags.
+   FRAME_HEADER_SIZE_2_2 = 6;
+
+   __slots__ = (
+      # The tag version.
+      "majorVersion", "minorVersion",
+      # The 4 character frame ID.
+      "id",
+      # The size of the data following this header.
+      "dataSize",
+      # The flags below as a bit field, in the same order whatever the
+      # version; see getFlagBits for where they are stored in the file.
+      "flags",
+      # For frames read from a file, a (file name, offset) tuple locating the
+      # data following this header.  None when the data does not appear in
+      # the file as is, i.e. the whole tag is unsynchronized.
+      "dataLocation",
+   );
+
+   tagAlter         = flagProperty(0x01);
+   fileAlter        = flagProperty(0x02);
+   readOnly         = flagProperty(0x04);
+   compressed       = flagProperty(0x08);
+   encrypted        = flagProperty(0x10);
+   grouped          = flagProperty(0x20);
+   unsync           = flagProperty(0x40);
+   dataLenIndicator = flagProperty(0x80);
+
+   # The bit positions of the flags above in the 16 bits of frame header
+   # flags, by version.  2.4 not only added flag bits, but also reordered the
+   # previously defined ones.  1.x tags are converted to 2.4 frames
+   # internally; 2.2 frames have no flags.
+   FLAG_BITS = {
+      # The unsync bit is not really in 2.3 frame header flags, but there is
+      # a "global" unsync bit in the tag header and that is written here so
+      # access to the tag header is not required.  The data length indicator
+      # is mapped to an unused bit, so that 0 is read.
+      (2, 3): (0, 1, 2, 8, 9, 10, 14, 4),
+      (2, 4): (1, 2, 3, 12, 13, 9, 14, 15),
+      (1, 0): (1, 2, 3, 12, 13, 9, 14, 15),
+      (1, 1): (1, 2, 3, 12, 13, 9, 14, 15),
+   };
+   NO_FLAG_BITS = (None,) * 8;
 
    # Constructor.
    def __init__(self, tagHeader = None):
+      self.id = None;
+      self.dataSize = 0;
+      self.flags = 0;
+      self.dataLocation = None;
       if tagHeader:
          self.setVersion(tagHeader);
       else:
@@ -362,89 +400,68 @@ class FrameHeader:
          self.minorVersion = tagHeader.minorVersion;
       self.setBitMask();
 
+   # Checks that frame headers of the version are supported.
    def setBitMask(self):
       major = self.majorVersion;
       minor = self.minorVersion;
-
-      # 1.x tags are converted to 2.4 frames internally.  These frames are
-      # created with frame flags \x00.
-      if (major == 2 and minor == 2):
-          # no flags for 2.2 frames
-          pass;
-      elif (major == 2 and minor == 3):
-         self.TAG_ALTER   = 0;   
-         self.FILE_ALTER  = 1;   
-         self.READ_ONLY   = 2;   
-         self.COMPRESSION = 8;   
-         self.ENCRYPTION  = 9;   
-         self.GROUPING    = 10;   
-         # This is not really in 2.3 frame header flags, but there is
-         # a "global" unsync bit in the tag header and that is written here
-         # so access to the tag header is not required.
-         self.UNSYNC      = 14;   
-         # And this is mapped to an used bit, so that 0 is returned.
-         self.DATA_LEN    = 4;
-      elif (major == 2 and minor == 4) or \
-           (major == 1 and (minor == 0 or minor == 1)):
-         self.TAG_ALTER   = 1;   
-         self.FILE_ALTER  = 2;   
-         self.READ_ONLY   = 3;   
-         self.COMPRESSION = 12;   
-         self.ENCRYPTION  = 13;   
-         self.GROUPING    = 9;   
-         self.UNSYNC      = 14;   
-         self.DATA_LEN    = 15;   
-      else:
+      if not (major == 2 and minor == 2) and\
+         not self.FLAG_BITS.has_key((major, minor)):
          raise ValueError("ID3 v" + str(major) + "." + str(minor) +\
                           " is not supported.");
 
+   # Returns the values of the header's attributes, which compare equal only
+   # if the header is unchanged.
+   def getState(self):
+      return (self.majorVersion, self.minorVersion, self.id, self.dataSize,
+              self.flags, self.dataLocation);
+
    def render(self, dataSize):
       data = self.id;
 
       if self.minorVersion == 3:
-         data += bin2bytes(dec2bin(dataSize, 32));
+         data += int2bytes(dataSize, 4);
       else:
-         data += bin2bytes(bin2synchsafe(dec2bin(dataSize, 32)));
+         data += int2synchsafe(dataSize, 4);
 
-      self.setBitMask();
-      self.flags = NULL_FRAME_FLAGS;
-      self.flags[self.TAG_ALTER] = self.tagAlter;
-      self.flags[self.FILE_ALTER] = self.fileAlter;
-      self.flags[self.READ_ONLY] = self.readOnly;
-      self.flags[self.COMPRESSION] = self.compressed;
-      self.flags[self.COMPRESSION] = self.compressed;
-      self.flags[self.ENCRYPTION] = self.encrypted;
-      self.flags[self.GROUPING] = self.grouped;
-      self.flags[self.UNSYNC] = self.unsync;
-      self.flags[self.DATA_LEN] = self.dataLenIndicator;
-
-      data += bin2bytes(self.flags);
+      flags = self.flags;
+      if flags:
+         data += flags2bytes([(flags >> i) & 1 for i in range(8)],
+                             self.getFlagBits(), 2);
+      else:
+         data += "\x00\x00";
 
       return data;
 
+   # Returns the size of the frame header in the file.
+   def getHeaderSize(self):
+      if self.minorVersion == 2:
+         return self.FRAME_HEADER_SIZE_2_2;
+      return self.FRAME_HEADER_SIZE;
+
    def parse2_2(self, f):
-      frameId = f.read(3);
+      return self.decode2_2(f.read(self.FRAME_HEADER_SIZE_2_2));
+
+   def decode2_2(self, data, offset = 0):
+      frameId = data[offset:offset + 3];
       frameId = map2_2FrameId(frameId);
       if self.isFrameIdValid(frameId):
-         TRACE_MSG("FrameHeader [id]: %s (0x%x%x%x)" % (frameId,
-                                                       ord(frameId[0]),
-                                                       ord(frameId[1]),
-                                                       ord(frameId[2])));
          self.id = frameId;
          # dataSize corresponds to the size of the data segment after
          # encryption, compression, and unsynchronization.
-         sz = f.read(3);
-         self.dataSize = bin2dec(bytes2bin(sz, 8));
-         TRACE_MSG("FrameHeader [data size]: %d (0x%X)" % (self.dataSize,
-                                                           self.dataSize));
+         sz = data[offset + 3:offset + 6];
+         self.dataSize = bytes2int(sz);
+         if utils.TRACE:
+            TRACE_MSG("FrameHeader [id]: %s (0x%s)", frameId,
+                      frameId.encode("hex"));
+            TRACE_MSG("FrameHeader [data size]: %d (0x%X)", self.dataSize,
+                      self.dataSize);
       elif frameId == '\x00\x00\x00':
-         TRACE_MSG("FrameHeader: Null frame id found at byte " +\
-                   str(f.tell()));
+         TRACE_MSG("FrameHeader: Null frame id found at byte %d", offset);
          return 0;
       elif not strictID3() and frameId in KNOWN_BAD_FRAMES:
          TRACE_MSG("FrameHeader: Illegal but known "\
                    "(possibly created by the shitty mp3ext) frame found; "\
-                   "Happily ignoring!" + str(f.tell()));
+                   "Happily ignoring!%d", offset);
          return 0;
       else:
          raise FrameException("FrameHeader: Illegal Frame ID: " + frameId);
@@ -455,89 +472,97 @@ class FrameHeader:
    # padding).  In the case of an invalid frame header, a FrameException is 
    # thrown.
    def parse(self, f):
-      TRACE_MSG("FrameHeader [start byte]: %d (0x%X)" % (f.tell(),
-                                                         f.tell()));
+      if utils.TRACE:
+         TRACE_MSG("FrameHeader [start byte]: %d (0x%X)", f.tell(), f.tell());
+      return self.decode(f.read(self.getHeaderSize()));
+
+   # Like parse, but decodes the header found at offset in the string data.
+   def decode(self, data, offset = 0):
       if self.minorVersion == 2:
-          return self.parse2_2(f)
+          return self.decode2_2(data, offset);
       
-      frameId = f.read(4);
+      frameId = data[offset:offset + 4];
       if self.isFrameIdValid(frameId):
-         TRACE_MSG("FrameHeader [id]: %s (0x%x%x%x%x)" % (frameId,
-                                                       ord(frameId[0]),
-                                                       ord(frameId[1]),
-                                                       ord(frameId[2]),
-                                                       ord(frameId[3])));
          self.id = frameId;
          # dataSize corresponds to the size of the data segment after
          # encryption, compression, and unsynchronization.
-         sz = f.read(4);
+         sz = data[offset + 4:offset + 8];
          # In ID3 v2.4 this value became a synch-safe integer, meaning only
          # the low 7 bits are used per byte.
          if self.minorVersion == 3:
-            self.dataSize = bin2dec(bytes2bin(sz, 8));
+            self.dataSize = bytes2int(sz);
          else:
-            self.dataSize = bin2dec(bytes2bin(sz, 7));
-         TRACE_MSG("FrameHeader [data size]: %d (0x%X)" % (self.dataSize,
-                                                           self.dataSize));
+            self.dataSize = synchsafe2int(sz);
  
-         # Frame flags.
-         flags = f.read(2);
-         self.flags = bytes2bin(flags);
-         self.tagAlter = self.flags[self.TAG_ALTER];
-         self.fileAlter = self.flags[self.FILE_ALTER];
-         self.readOnly = self.flags[self.READ_ONLY];
-         self.compressed = self.flags[self.COMPRESSION];
-         self.encrypted = self.flags[self.ENCRYPTION];
-         self.grouped = self.flags[self.GROUPING];
-         self.unsync = self.flags[self.UNSYNC];
-         self.dataLenIndicator = self.flags[self.DATA_LEN];
-         TRACE_MSG("FrameHeader [flags]: ta(%d) fa(%d) ro(%d) co(%d) "\
-                   "en(%d) gr(%d) un(%d) dl(%d)" % (self.tagAlter,
-                                                    self.fileAlter,
-                                                    self.readOnly,
-                                                    self.compressed,
-                                                    self.encrypted,
-                                                    self.grouped,
-                                                    self.unsync,
-                                                    self.dataLenIndicator));
+         # Frame flags, which are nearly always all clear.
+         flags = data[offset + 8:offset + 10];
+         self.flags = 0;
+         if flags != "\x00\x00":
+            values = bytes2flags(flags, self.getFlagBits());
+            for i in range(8):
+               self.flags |= values[i] << i;
+         if utils.TRACE:
+            TRACE_MSG("FrameHeader [id]: %s (0x%s)", frameId,
+                      frameId.encode("hex"));
+            TRACE_MSG("FrameHeader [data size]: %d (0x%X)", self.dataSize,
+                      self.dataSize);
+            TRACE_MSG("FrameHeader [flags]: ta(%d) fa(%d) ro(%d) co(%d) "\
+                      "en(%d) gr(%d) un(%d) dl(%d)", self.tagAlter,
+                      self.fileAlter, self.readOnly, self.compressed,
+                      self.encrypted, self.grouped, self.unsync,
+                      self.dataLenIndicator);
          if self.minorVersion >= 4 and self.compressed and \
             not self.dataLenIndicator:
             raise FrameException("Invalid frame; compressed with no data "
                                  "length indicator");
 
       elif frameId == '\x00\x00\x00\x00':
-         TRACE_MSG("FrameHeader: Null frame id found at byte " +\
-                   str(f.tell()));
+         TRACE_MSG("FrameHeader: Null frame id found at byte %d", offset);
          return 0;
       elif not strictID3() and frameId in KNOWN_BAD_FRAMES:
          TRACE_MSG("FrameHeader: Illegal but known "\
                    "(possibly created by the shitty mp3ext) frame found; "\
-                   "Happily ignoring!" + str(f.tell()));
+                   "Happily ignoring!%d", offset);
          return 0;
       else:
          raise FrameException("FrameHeader: Illegal Frame ID: " + frameId);
       return 1;
 
+   # Returns the bit positions of the tagAlter, fileAlter, readOnly,
+   # compressed, encrypted, grouped, unsync and dataLenIndicator flags.
+   def getFlagBits(self):
+      return self.FLAG_BITS.get((self.majorVersion, self.minorVersion),
+                                self.NO_FLAG_BITS);
 
    def isFrameIdValid(self, id):
-      return re.compile(r"^[A-Z0-9][A-Z0-9][A-Z0-9][A-Z0-9]$").match(id);
+      return FRAME_ID_RX.match(id);
 
    def clearFlags(self):
-      flags = [0] * 16;
+      self.flags = 0;
 
 ################################################################################
+# A 0xff byte followed by a byte that would make it look like an mp3 frame
+# sync (or by a 0x00 byte, so the scheme can be reversed) has a 0x00 byte
+# inserted after it; see section 6.1 of the ID3 2.4 spec.
+UNSYNC_RX = re.compile("\xff(?=[\x00\xe0-\xff])");
+DEUNSYNC_RX = re.compile("\xff\x00(?=[\x00\xe0-\xff])");
+
 def unsyncData(data):
-   (data, s0) = re.compile("\xff\x00").subn("\xff\x00\x00", data);
-   (data, s1) = re.compile("\xff(?=[\xe0-\xff])").subn("\xff\x00", data);
-   TRACE_MSG("Unsynchronizing data: (%d,%d)" % (s0, s1));
+   # Most data, and all text, contains no 0xff bytes at all.
+   if data.find("\xff") == -1:
+      return data;
+   (data, s) = UNSYNC_RX.subn("\xff\x00", data);
+   TRACE_MSG("Unsynchronizing data: (%d)", s);
    return data;
 
 def deunsyncData(data):
-   TRACE_MSG("Frame: [size before deunsync]: " + str(len(data)));
-   data = re.compile("\xff\x00([\xe0-\xff])").sub("\xff\\1", data);
-   TRACE_MSG("Frame: [size after stage #1 deunsync]: " + str(len(data)));
-   data = re.compile("\xff\x00\x00").sub("\xff\x00", data);
-   TRACE_MSG("Frame: [size after deunsync: " + str(len(data)));
+   if data.find("\xff\x00") == -1:
+      return data;
+   if utils.TRACE:
+      TRACE_MSG("Frame: [size before deunsync]: %d", len(data));
+   data = DEUNSYNC_RX.sub("\xff", data);
+   if utils.TRACE:
+      TRACE_MSG("Frame: [size after deunsync: %d", len(data));
    return data;
 
 ################################################################################
@@ -548,11 +573,32 @@ class Frame:
    encryptionMethod = 0;
    dataLen = 0;
    encoding = DEFAULT_ENCODING;
+   # The result of the last getRendered call, with the state of the frame and
+   # its header after it.
+   renderCache = None;
 
    def __init__(self, frameHeader):
        assert(isinstance(frameHeader, FrameHeader));
        self.header = frameHeader;
 
+   # Returns the rendered frame like render(), but only renders it if the
+   # frame or its header have changed since the last call.  Changes are
+   # detected by comparing their attributes with those saved by that call,
+   # so saving a tag renders each changed frame once and no others.
+   def getRendered(self):
+      state = self.__dict__.copy();
+      cache = state.pop("renderCache", None);
+      if cache is not None and cache[1] == state and\
+         cache[2] == self.header.getState():
+         return cache[0];
+
+      data = self.render();
+      # Rendering can itself update the frame and header.
+      state = self.__dict__.copy();
+      state.pop("renderCache", None);
+      self.renderCache = (data, state, self.header.getState());
+      return data;
+
    def __str__(self):
       desc = self.getFrameDesc();
       return '<%s Frame (%s)>' % (desc, self.header.id);
@@ -567,15 +613,19 @@ class Frame:
       return data;
 
    def decompress(self, data):
-      TRACE_MSG("before decompression: %d bytes" % len(data));
+      if utils.TRACE:
+         TRACE_MSG("before decompression: %d bytes", len(data));
       data = zlib.decompress(data, 15, self.decompressedSize);
-      TRACE_MSG("after decompression: %d bytes" % len(data));
+      if utils.TRACE:
+         TRACE_MSG("after decompression: %d bytes", len(data));
       return data;
 
    def compress(self, data):
-      TRACE_MSG("before compression: %d bytes" % len(data));
+      if utils.TRACE:
+         TRACE_MSG("before compression: %d bytes", len(data));
       data = zlib.compress(data);
-      TRACE_MSG("after compression: %d bytes" % len(data));
+      if utils.TRACE:
+         TRACE_MSG("after compression: %d bytes", len(data));
       return data;
 
    def decrypt(self, data):
@@ -590,34 +640,34 @@ class Frame:
       if self.header.minorVersion == 3:
          # 2.3:  compression(4), encryption(1), group(1) 
          if self.header.compressed:
-            self.decompressedSize = bin2dec(bytes2bin(data[:4]));
+            self.decompressedSize = bytes2int(data[:4]);
             data = data[4:];
-            TRACE_MSG("Decompressed Size: %d" % self.decompressedSize);
+            TRACE_MSG("Decompressed Size: %d", self.decompressedSize);
          if self.header.encrypted:
-            self.encryptionMethod = bin2dec(bytes2bin(data[0]));
+            self.encryptionMethod = ord(data[0]);
             data = data[1:];
-            TRACE_MSG("Encryption Method: %d" % self.encryptionMethod);
+            TRACE_MSG("Encryption Method: %d", self.encryptionMethod);
          if self.header.grouped:
-            self.groupId = bin2dec(bytes2bin(data[0]));
+            self.groupId = ord(data[0]);
             data = data[1:];
-            TRACE_MSG("Group ID: %d" % self.groupId);
+            TRACE_MSG("Group ID: %d", self.groupId);
       else:
          # 2.4:  group(1), encrypted(1), dataLenIndicator(4,7)
          if self.header.grouped:
-            self.groupId = bin2dec(bytes2bin(data[0]));
+            self.groupId = ord(data[0]);
             data = data[1:];
          if self.header.encrypted:
-            self.encryptionMethod = bin2dec(bytes2bin(data[0]));
+            self.encryptionMethod = ord(data[0]);
             data = data[1:];
-            TRACE_MSG("Encryption Method: %d" % self.encryptionMethod);
-            TRACE_MSG("Group ID: %d" % self.groupId);
+            TRACE_MSG("Encryption Method: %d", self.encryptionMethod);
+            TRACE_MSG("Group ID: %d", self.groupId);
          if self.header.dataLenIndicator:
-            self.dataLen = bin2dec(bytes2bin(data[:4], 7));
+            self.dataLen = synchsafe2int(data[:4]);
             data = data[4:];
-            TRACE_MSG("Data Length: %d" % self.dataLen);
+            TRACE_MSG("Data Length: %d", self.dataLen);
             if self.header.compressed:
                self.decompressedSize = self.dataLen;
-               TRACE_MSG("Decompressed Size: %d" % self.decompressedSize);
+               TRACE_MSG("Decompressed Size: %d", self.decompressedSize);
 
       if self.header.unsync:
          data = self.deunsync(data);
@@ -631,20 +681,20 @@ class Frame:
       formatFlagData = "";
       if self.header.minorVersion == 3:
          if self.header.compressed:
-            formatFlagData += bin2bytes(dec2bin(len(data), 32));
+            formatFlagData += int2bytes(len(data), 4);
          if self.header.encrypted:
-            formatFlagData += bin2bytes(dec2bin(self.encryptionMethod, 8));
+            formatFlagData += int2bytes(self.encryptionMethod, 1);
          if self.header.grouped:
-            formatFlagData += bin2bytes(dec2bin(self.groupId, 8));
+            formatFlagData += int2bytes(self.groupId, 1);
       else:
          if self.header.grouped:
-            formatFlagData += bin2bytes(dec2bin(self.groupId, 8));
+            formatFlagData += int2bytes(self.groupId, 1);
          if self.header.encrypted:
-            formatFlagData += bin2bytes(dec2bin(self.encryptionMethod, 8));
+            formatFlagData += int2bytes(self.encryptionMethod, 1);
          if self.header.compressed or self.header.dataLenIndicator:
             # Just in case, not sure about this?
             self.header.dataLenIndicator = 1;
-            formatFlagData += bin2bytes(dec2bin(len(data), 32));
+            formatFlagData += int2bytes(len(data), 4);
 
       if self.header.compressed:
           data = self.compress(data);
@@ -699,7 +749,9 @@ class TextFrame(Frame):
 
       data = self.disassembleFrame(data);
       self.encoding = data[0];
-      TRACE_MSG("TextFrame encoding: %s" % id3EncodingToString(self.encoding));
+      if utils.TRACE:
+         TRACE_MSG("TextFrame encoding: %s",
+                   id3EncodingToString(self.encoding));
       try:
           self.text = unicode(data[1:], id3EncodingToString(self.encoding));
           if not strictID3():
@@ -712,7 +764,7 @@ class TextFrame(Frame):
                  self.text = cleanNulls(self.text)
           else:
               raise;
-      TRACE_MSG("TextFrame text: %s" % self.text);
+      TRACE_MSG("TextFrame text: %s", self.text);
 
    def __unicode__(self):
       return u'<%s (%s): %s>' % (self.getFrameDesc(), self.header.id,
@@ -878,15 +930,16 @@ class UserTextFrame(TextFrame):
 
       data = self.disassembleFrame(data);
       self.encoding = data[0];
-      TRACE_MSG("UserTextFrame encoding: %s" %\
-                id3EncodingToString(self.encoding));
+      if utils.TRACE:
+         TRACE_MSG("UserTextFrame encoding: %s",
+                   id3EncodingToString(self.encoding));
       (d, t) = splitUnicode(data[1:], self.encoding);
       self.description = unicode(d, id3EncodingToString(self.encoding));
-      TRACE_MSG("UserTextFrame description: %s" % self.description);
+      TRACE_MSG("UserTextFrame description: %s", self.description);
       self.text = unicode(t, id3EncodingToString(self.encoding));
       if not strictID3():
           self.text = cleanNulls(self.text)
-      TRACE_MSG("UserTextFrame text: %s" % self.text);
+      TRACE_MSG("UserTextFrame text: %s", self.text);
 
    def render(self):
       data = self.encoding +\
@@ -962,15 +1015,16 @@ class UserURLFrame(URLFrame):
 
       data = self.disassembleFrame(data);
       self.encoding = data[0];
-      TRACE_MSG("UserURLFrame encoding: %s" %\
-                id3EncodingToString(self.encoding));
+      if utils.TRACE:
+         TRACE_MSG("UserURLFrame encoding: %s",
+                   id3EncodingToString(self.encoding));
       (d, u) = splitUnicode(data[1:], self.encoding);
       self.description = unicode(d, id3EncodingToString(self.encoding));
-      TRACE_MSG("UserURLFrame description: %s" % self.description);
+      TRACE_MSG("UserURLFrame description: %s", self.description);
       self.url = u;
       if not strictID3():
           self.url = cleanNulls(self.url)
-      TRACE_MSG("UserURLFrame text: %s" % self.url);
+      TRACE_MSG("UserURLFrame text: %s", self.url);
 
    def render(self):
       data = self.encoding +\
@@ -1017,13 +1071,15 @@ class CommentFrame(Frame):
 
       data = self.disassembleFrame(data);
       self.encoding = data[0];
-      TRACE_MSG("CommentFrame encoding: " + id3EncodingToString(self.encoding));
+      if utils.TRACE:
+         TRACE_MSG("CommentFrame encoding: %s",
+                   id3EncodingToString(self.encoding));
       try:
           self.lang = str(data[1:4]).strip("\x00");
           # Test ascii encoding
           temp_lang = unicode(self.lang, "ascii");
           if self.lang and \
-             not re.compile("[A-Z][A-Z][A-Z]", re.IGNORECASE).match(self.lang):
+             not LANG_RX.match(self.lang):
              if strictID3():
                  raise FrameException("[CommentFrame] Invalid language "\
                                        "code: %s" % self.lang);
@@ -1071,9 +1127,16 @@ class ImageFrame(Frame):
    mimeType = None;
    pictureType = None;
    description = u"";
-   # Contains the image data when the mimetype is image type.
-   # Otherwise it is None.
-   imageData = None;
+   # imageData contains the image data when the mimetype is image type.
+   # Otherwise it is None.  For frames read from a file the data is left
+   # there, at imageLocation (a (file name, offset) tuple), and is only read
+   # when imageData is first accessed (see __getattr__).  The file must not
+   # be changed in the meantime; Tag.update and Tag.remove load it first,
+   # and frames which have not been decoded yet are detached from the file
+   # (see LazyFrame.detach).
+   imageLocation = None;
+   # The size of the image data, in bytes.
+   imageSize = 0;
    # Contains a URL for the image when the mimetype is "-->" per the spec.
    # Otherwise it is None.
    imageURL = None;
@@ -1120,7 +1183,9 @@ class ImageFrame(Frame):
            self.pictureType = pictureType;
            if imageData:
                self.imageData = imageData;
+               self.imageSize = len(imageData);
            else:
+               self.imageData = None;
                self.imageURL = imageURL;
            assert(self.imageData or self.imageURL);
      
@@ -1133,13 +1198,15 @@ class ImageFrame(Frame):
        # Load img
        fp = file(imgFile, "rb");
        imgData = fp.read();
+       # mimetypes (and the urllib it imports) is only loaded when needed.
+       import mimetypes;
        mt = mimetypes.guess_type(imgFile);
        if not mt[0]:
            raise FrameException("Unable to guess mime-type for %s" % (imgFile));
 
        frameData = DEFAULT_ENCODING;
        frameData += mt[0] + "\x00";
-       frameData += bin2bytes(dec2bin(type, 8));
+       frameData += int2bytes(type, 1);
        frameData += desc.encode(id3EncodingToString(encoding)) + "\x00";
        frameData += imgData;
  
@@ -1162,26 +1229,34 @@ class ImageFrame(Frame):
          raise FrameException("Invalid frame id for ImageFrame: " +\
                               frameHeader.id);
 
-      data = self.disassembleFrame(data);
-
-      input = StringIO(data);
-      TRACE_MSG("APIC frame data size: " + str(len(data)));
-      self.encoding = input.read(1);
-      TRACE_MSG("APIC encoding: " + id3EncodingToString(self.encoding));
-
-      self.mimeType = "";
-      ch = input.read(1);
-      while ch != "\x00":
-         self.mimeType += ch;
-         ch = input.read(1);
-      TRACE_MSG("APIC mime type: " + self.mimeType);
+      # The picture data can be left in the file unless it has to be
+      # transformed first.  data may be a buffer, so it is searched with
+      # regular expressions and only the parts needed are copied out.
+      location = frameHeader.dataLocation;
+      if frameHeader.compressed or frameHeader.encrypted or\
+         frameHeader.grouped or frameHeader.unsync or\
+         frameHeader.dataLenIndicator:
+         location = None;
+         data = self.disassembleFrame(str(data));
+
+      self.encoding = data[0:1];
+      if utils.TRACE:
+         TRACE_MSG("APIC frame data size: %d", len(data));
+         TRACE_MSG("APIC encoding: %s", id3EncodingToString(self.encoding));
+
+      mimeEnd = NULL_RX.search(data, 1);
+      if not mimeEnd:
+         raise FrameException("APIC frame mime type is not terminated");
+      pos = mimeEnd.start();
+      self.mimeType = data[1:pos];
+      TRACE_MSG("APIC mime type: %s", self.mimeType);
       if strictID3() and not self.mimeType:
          raise FrameException("APIC frame does not contain a mime type");
       if self.mimeType.find("/") == -1:
          self.mimeType = "image/" + self.mimeType;
 
-      pt = ord(input.read(1));
-      TRACE_MSG("Initial APIC picture type: " + str(pt));
+      pt = ord(data[pos + 1]);
+      TRACE_MSG("Initial APIC picture type: %d", pt);
       if pt < self.MIN_TYPE or pt > self.MAX_TYPE:
           if strictID3():
               raise FrameException("Invalid APIC picture type: %d" % (pt));
@@ -1194,42 +1269,86 @@ class ImageFrame(Frame):
           if pt < self.MIN_TYPE or pt > self.MAX_TYPE:
               self.pictureType = self.OTHER;
       self.pictureType = pt;
-      TRACE_MSG("APIC picture type: " + str(self.pictureType));
-
-      self.desciption = u"";
+      TRACE_MSG("APIC picture type: %d", self.pictureType);
 
       # Remaining data is a NULL separated description and image data
-      buffer = input.read();
-      input.close();
-
-      (desc, img) = splitUnicode(buffer, self.encoding);
-      TRACE_MSG("description len: %d" % len(desc));
-      TRACE_MSG("description len: %d" % len(img));
+      descStart = pos + 2;
+      (descEnd, pos) = findTextEnd(data, self.encoding, descStart);
+      desc = data[descStart:descEnd];
       self.description = unicode(desc, id3EncodingToString(self.encoding));
-      TRACE_MSG("APIC description: " + self.description);
+      if utils.TRACE:
+         TRACE_MSG("description len: %d", len(desc));
+         TRACE_MSG("APIC description: %s", self.description);
 
+      self.imageSize = len(data) - pos;
       if self.mimeType.find("-->") != -1:
          self.imageData = None;
-         self.imageURL = img;
+         self.imageURL = data[pos:];
+      elif location is not None:
+         self.imageLocation = (location[0], location[1] + pos);
+         self.imageURL = None;
       else:
-         self.imageData = img;
+         self.imageData = data[pos:];
          self.imageURL = None;
-      TRACE_MSG("APIC image data: " + str(len(self.imageData)) + " bytes");
-      if strictID3() and not self.imageData and not self.imageURL:
+      TRACE_MSG("APIC image data: %d bytes", self.imageSize);
+      if strictID3() and not self.imageSize:
          raise FrameException("APIC frame does not contain any image data");
 
+   # Only called for attributes which are not set, i.e. imageData when it
+   # has not been loaded yet.
+   def __getattr__(self, name):
+      if name != "imageData":
+         raise AttributeError(name);
+      self.imageData = self.__readImage();
+      return self.imageData;
 
+   def __readImage(self):
+      if self.imageLocation is None:
+         return None;
+      (fileName, offset) = self.imageLocation;
+      TRACE_MSG("Reading %d bytes of APIC image data from %s at %d",
+                self.imageSize, fileName, offset);
+      fp = file(fileName, "rb");
+      try:
+         fp.seek(offset);
+         data = fp.read(self.imageSize);
+      finally:
+         fp.close();
+      if len(data) != self.imageSize:
+         raise FrameException("APIC image data could not be read from " +\
+                              fileName);
+      return data;
+
+   # Write the image to a file.  Image data which has not been loaded is
+   # copied from the tagged file in blocks rather than read into memory.
    def writeFile(self, path = "./", name = None):
-      if not self.imageData:
+      stream = not self.__dict__.has_key("imageData") and\
+               self.imageLocation is not None;
+      if not stream and not self.imageData:
          raise IOError("Fetching remote image files is not implemented.");
       if not name:
          name = self.getDefaultFileName();
       imageFile = os.path.join(path, name);
 
       f = file(imageFile, "wb");
-      f.write(self.imageData);
-      f.flush();
-      f.close();
+      try:
+         if stream:
+            (fileName, offset) = self.imageLocation;
+            src = file(fileName, "rb");
+            try:
+               src.seek(offset);
+               copied = copyData(src, f, self.imageSize);
+            finally:
+               src.close();
+            if copied != self.imageSize:
+               raise FrameException("APIC image data could not be read "\
+                                    "from " + fileName);
+         else:
+            f.write(self.imageData);
+         f.flush();
+      finally:
+         f.close();
+
    def getDefaultFileName(self):
       nameStr = self.picTypeToString(self.pictureType);
       nameStr = nameStr +  "." + self.mimeType.split("/")[1];
@@ -1237,7 +1356,7 @@ class ImageFrame(Frame):
 
    def render(self):
       data = self.encoding + self.mimeType + "\x00" +\
-             bin2bytes(dec2bin(self.pictureType, 8)) +\
+             int2bytes(self.pictureType, 1) +\
              self.description.encode(id3EncodingToString(self.encoding)) +\
              self.getTextDelim();
       if self.imageURL:
@@ -1353,10 +1472,10 @@ class PlayCountFrame(Frame):
     def _set(self, data, frameHeader):
         assert(frameHeader);
         assert(len(data) >= 4);
-        self.count = long(bytes2dec(data));
+        self.count = long(bytes2int(data));
         
     def render(self):
-        data = dec2bytes(self.count, 32);
+        data = int2bytes(self.count, 4);
         return self.assembleFrame(data);
 
 class UniqueFileIDFrame(Frame):
@@ -1379,8 +1498,8 @@ class UniqueFileIDFrame(Frame):
         # Owner identifier <text string> $00
         # Identifier       up to 64 bytes binary data>
         (self.owner_id, self.id) = data.split("\x00", 1);
-        TRACE_MSG("UFID owner_id: " + self.owner_id);
-        TRACE_MSG("UFID id: " + self.id);
+        TRACE_MSG("UFID owner_id: %s", self.owner_id);
+        TRACE_MSG("UFID id: %s", self.id);
         if strictID3() and (len(self.owner_id) == 0 or
                             len(self.id) == 0 or len(self.id) > 64):
             raise FrameException("Invalid UFID frame");
@@ -1428,13 +1547,63 @@ class MusicCDIdFrame(Frame):
       data = self.toc;
       return self.assembleFrame(data);
 
+################################################################################
+# Stand-in for a frame whose body has not been decoded yet.  Only the header
+# is parsed; the raw body is decoded by decode(), which turns this object into
+# an instance of the real frame class in place so that any references to it
+# remain valid.  FrameSet decodes these before returning them, so callers
+# normally never see one.
+class LazyFrame:
+   header = None;
+   rawData = None;
+   # The state of the header (see FrameHeader.getState) when the frame was
+   # read.
+   headerState = None;
+
+   def __init__(self, frameHeader, data):
+      self.header = frameHeader;
+      self.rawData = data;
+      self.headerState = frameHeader.getState();
+
+   # A frame which has not been decoded is unchanged, so as long as its
+   # header is too (in particular, the tag version) the data read can be
+   # written back as is.
+   def getRendered(self):
+      if self.header.getState() != self.headerState:
+         return self.decode().getRendered();
+      return self.header.render(len(self.rawData)) + str(self.rawData);
+
+   # Forgets where in the file the frame was read from, once the file has
+   # been rewritten; the body is decoded from rawData, which is in memory.
+   def detach(self):
+      self.header.dataLocation = None;
+      self.headerState = self.header.getState();
+
+   def decode(self):
+      frame = createFrame(self.header, self.rawData);
+      self.__dict__ = frame.__dict__;
+      self.__class__ = frame.__class__;
+      return self;
+
+   # Called only for attributes a LazyFrame does not have, i.e. those of the
+   # decoded frame.  Special methods are excluded so that comparisons and
+   # truth tests do not force a decode.
+   def __getattr__(self, name):
+      if name[:2] == "__":
+         raise AttributeError(name);
+      return getattr(self.decode(), name);
+
 ################################################################################
 # A class for containing and managing ID3v2.Frame objects.
 class FrameSet(list):
    tagHeader = None;
+   # Maps frame IDs to the list of frames with that ID, in tag order.  Every
+   # method that changes the list keeps this in sync.
+   frameMap = None;
 
    def __init__(self, tagHeader, l = None):
       self.tagHeader = tagHeader;
+      self.frameMap = {};
       if l:
          for f in l:
             if not isinstance(f, Frame):
@@ -1445,18 +1614,90 @@ class FrameSet(list):
    # Setting a FrameSet instance like this 'fs = []' morphs the instance into
    # a list object.
    def clear(self):
-      del self[0:];
+      list.__delslice__(self, 0, len(self));
+      self.frameMap = {};
+
+   # Rebuild the frame ID map.  This is only needed after a frame ID has been
+   # changed in place, as DateFrame.render does when converting versions.
+   def reindex(self):
+      self.frameMap = {};
+      for f in list.__iter__(self):
+         self.frameMap.setdefault(f.header.id, []).append(f);
+
+   def append(self, frame):
+      list.append(self, frame);
+      self.frameMap.setdefault(frame.header.id, []).append(frame);
+
+   # The remaining list mutators are rare; they simply rebuild the map.
+   def extend(self, l):
+      list.extend(self, l);
+      self.reindex();
+
+   def insert(self, i, frame):
+      list.insert(self, i, frame);
+      self.reindex();
+
+   def remove(self, frame):
+      list.remove(self, frame);
+      self.reindex();
+
+   def pop(self, i = -1):
+      frame = list.pop(self, i);
+      self.reindex();
+      return frame;
+
+   def __setitem__(self, i, frame):
+      list.__setitem__(self, i, frame);
+      self.reindex();
+
+   def __delitem__(self, i):
+      list.__delitem__(self, i);
+      self.reindex();
+
+   def __setslice__(self, i, j, l):
+      list.__setslice__(self, i, j, l);
+      self.reindex();
+
+   def __delslice__(self, i, j):
+      list.__delslice__(self, i, j);
+      self.reindex();
+
+   def __iadd__(self, l):
+      self.extend(l);
+      return self;
 
    # Read frames starting from the current read position of the file object.
    # Returns the amount of padding which occurs after the tag, but before the
    # audio content.  A return valule of 0 DOES NOT imply an error.
-   def parse(self, f, tagHeader):
+   #
+   # When lazy is true only the frame headers are parsed; frame bodies are
+   # kept raw and decompressed, deunsynced and decoded on first access (see
+   # LazyFrame).  Errors in a frame body are then raised as a FrameException
+   # at that time rather than from parse.
+   #
+   # If frameIds is given only frames with those IDs are read; the bodies of
+   # all other frames are skipped with a seek.  Each item of frameIds is a
+   # frame ID or a tuple of alternative IDs in order of preference, such as
+   # ("TPE1", "TPE2"); every alternative found is kept, and parsing stops as
+   # soon as the first (preferred) ID of every item has been seen, since
+   # nothing later in the tag could be preferred to it.  The padding size is
+   # not known in that case and 0 is returned.  (A tag with
+   # the unsync bit set must be read in full, so frameIds only filters which
+   # frames are kept.)
+   def parse(self, f, tagHeader, lazy = 0, frameIds = None):
       self.tagHeader = tagHeader;
+      if frameIds is not None:
+         frameGroups = groupFrameIds(frameIds);
+         if not tagHeader.unsync:
+            return self.__parseSelected(f, tagHeader, lazy, frameIds,
+                                        frameGroups);
+
       paddingSize = 0;
       sizeLeft = tagHeader.tagSize;
 
       # Handle a tag-level unsync.  Some frames may have their own unsync bit
       # set instead.
+      tagOffset = f.tell();
       tagData = f.read(sizeLeft);
       og_size = sizeLeft;
       if tagHeader.unsync:
@@ -1465,55 +1706,136 @@ class FrameSet(list):
          sizeLeft = len(tagData);
       size_change = 0;
       if og_size != sizeLeft:
-          TRACE_MSG("De-unsyncing changed size: %d" % (og_size - sizeLeft));
+          TRACE_MSG("De-unsyncing changed size: %d", og_size - sizeLeft);
           # Deunsyncing changed the tag size we are working with.
           size_change = og_size - sizeLeft;
 
-      # Adding 10 to simulate the tag header in the buffer.  This keeps 
-      # f.tell() values matching the file itself.
-      tagBuffer = StringIO((10 * '\x00') + tagData);
-      tagBuffer.seek(10);
-      #tagBuffer.tell();
-
+      # Frame headers are decoded from tagData in place and frame bodies are
+      # buffer views into it, so only one copy of the tag is held in memory
+      # until the frames are decoded.
+      minFrameSize = FrameHeader(tagHeader).getHeaderSize() + 1;
+      pos = 0;
       while sizeLeft > 0:
-         TRACE_MSG("sizeLeft: " + str(sizeLeft));
-         if sizeLeft < (10 + 1):
+         if utils.TRACE:
+            TRACE_MSG("sizeLeft: %d", sizeLeft);
+         if sizeLeft < minFrameSize:
             TRACE_MSG("FrameSet: Implied padding (sizeLeft < minFrameSize)");
             paddingSize = sizeLeft;
             break;
 
-         TRACE_MSG("+++++++++++++++++++++++++++++++++++++++++++++++++");
-         TRACE_MSG("FrameSet: Reading Frame #" + str(len(self) + 1));
+         if utils.TRACE:
+            TRACE_MSG("+++++++++++++++++++++++++++++++++++++++++++++++++");
+            TRACE_MSG("FrameSet: Reading Frame #%d", len(self) + 1);
          frameHeader = FrameHeader(tagHeader);
-         if not frameHeader.parse(tagBuffer):
+         if not frameHeader.decode(tagData, pos):
             paddingSize = sizeLeft;
             break;
+         pos += frameHeader.getHeaderSize();
 
          # Frame data.
-         TRACE_MSG("FrameSet: Reading %d (0x%X) bytes of data from byte "\
-                   "pos %d (0x%X)" % (frameHeader.dataSize,
-                                      frameHeader.dataSize, tagBuffer.tell(),
-                                      tagBuffer.tell()));
-         data = tagBuffer.read(frameHeader.dataSize);
-         TRACE_MSG("FrameSet: %d bytes of data read" % len(data));
+         if utils.TRACE:
+            TRACE_MSG("FrameSet: Reading %d (0x%X) bytes of data from byte "\
+                      "pos %d (0x%X)", frameHeader.dataSize,
+                      frameHeader.dataSize, pos + 10, pos + 10);
+         data = buffer(tagData, pos, frameHeader.dataSize);
+         if not tagHeader.unsync:
+            self.__locate(f, frameHeader, tagOffset + pos);
+         pos += frameHeader.dataSize;
+         if utils.TRACE:
+            TRACE_MSG("FrameSet: %d bytes of data read", len(data));
+
+         if frameIds is None or frameGroups.has_key(frameHeader.id):
+            self.__addParsed(frameHeader, data, lazy);
+
+         sizeLeft = len(tagData) - pos;
 
-         self.addFrame(createFrame(frameHeader, data));
+      return paddingSize;
 
-         # Each frame contains dataSize + headerSize(10) bytes.
-         sizeLeft -= (frameHeader.FRAME_HEADER_SIZE + frameHeader.dataSize);
+   # Reads the frames named in frameIds directly from f, seeking past the
+   # bodies of any others, until the preferred frame of each item of frameIds
+   # is found.  frameGroups is as returned by groupFrameIds(frameIds).
+   def __parseSelected(self, f, tagHeader, lazy, frameIds, frameGroups):
+      # The preferred ID of each item which has not been seen yet.
+      notFound = {};
+      for i in range(len(frameIds)):
+         ids = frameIds[i];
+         if not isinstance(ids, str):
+            ids = ids[0];
+         notFound[i] = ids;
+
+      minFrameSize = FrameHeader(tagHeader).getHeaderSize() + 1;
+      tagEnd = f.tell() + tagHeader.tagSize;
+      while notFound:
+         sizeLeft = tagEnd - f.tell();
+         if sizeLeft < minFrameSize:
+            TRACE_MSG("FrameSet: Implied padding (sizeLeft < minFrameSize)");
+            return max(sizeLeft, 0);
 
-      return paddingSize;
+         frameHeader = FrameHeader(tagHeader);
+         if not frameHeader.parse(f):
+            return sizeLeft;
+
+         groups = frameGroups.get(frameHeader.id);
+         if groups is not None:
+            TRACE_MSG("FrameSet: Reading %d bytes of %s data",
+                      frameHeader.dataSize, frameHeader.id);
+            self.__locate(f, frameHeader, f.tell());
+            data = f.read(frameHeader.dataSize);
+            self.__addParsed(frameHeader, data, lazy);
+            for i in groups:
+               if notFound.get(i) == frameHeader.id:
+                  del notFound[i];
+         else:
+            TRACE_MSG("FrameSet: Skipping %d bytes of %s data",
+                      frameHeader.dataSize, frameHeader.id);
+            f.seek(frameHeader.dataSize, 1);
+
+      TRACE_MSG("FrameSet: All requested frames found");
+      return 0;
+
+   # Records where in the file f the frame's data begins, so that large frame
+   # bodies can be read on demand (see ImageFrame).
+   def __locate(self, f, frameHeader, offset):
+      fileName = getattr(f, "name", None);
+      if isinstance(fileName, str) and fileName[:1] != "<":
+         frameHeader.dataLocation = (fileName, offset);
+
+   def __addParsed(self, frameHeader, data, lazy):
+      if lazy:
+         # The addFrame checks need decoded bodies, so they are skipped
+         # for frames read from the file.
+         self.append(LazyFrame(frameHeader, data));
+      else:
+         self.addFrame(createFrame(frameHeader, data));
+
+   # Renders each frame (see Frame.getRendered), without decoding frames which
+   # were parsed lazily and have not been accessed.  Returns the list of
+   # rendered frames in tag order.
+   def render(self):
+      rendered = [];
+      for f in list.__iter__(self):
+         TRACE_MSG("Rendering frame: %s", f.header.id);
+         data = f.getRendered();
+         if utils.TRACE:
+            TRACE_MSG("Rendered %d bytes", len(data));
+         rendered.append(data);
+      return rendered;
 
    # Returrns the size of the frame data.
    def getSize(self):
       sz = 0;
-      for f in self:
-         sz += len(f.render());
+      for f in list.__iter__(self):
+         sz += len(f.getRendered());
       return sz;
    
    def setTagHeader(self, tagHeader):
       self.tagHeader = tagHeader;
-      for f in self:
+      for f in list.__iter__(self):
+         # Frame data must be decoded as the version it was read as.
+         if isinstance(f, LazyFrame) and\
+            (f.header.majorVersion != tagHeader.majorVersion or\
+             f.header.minorVersion != tagHeader.minorVersion):
+            f.decode();
          f.header.setVersion(tagHeader);
 
    # This methods adds the frame if it is addable per the ID3 spec.
@@ -1561,7 +1883,7 @@ class FrameSet(list):
       # Image (attached picture) frame restrictions.
       # Multiples must have a unique content desciptor.  I'm assuming that
       # the spec means the picture type.....
-      if IMAGE_FRAME_RX.match(fid) and self[fid]:
+      if fid == IMAGE_FID and self[fid]:
          imageFrames = self[fid];
          for frm in imageFrames:
             if frm.pictureType == frame.pictureType:
@@ -1569,12 +1891,12 @@ class FrameSet(list):
                                     "content descriptor now allowed." % fid);
 
       # Play count frame (PCNT).  There may be only one
-      if PLAYCOUNT_FRAME_RX.match(fid) and self[fid]:
+      if fid == PLAYCOUNT_FID and self[fid]:
          raise FrameException("Multiple %s frames now allowed." % fid);
 
       # Unique File identifier frame.  There may be only one with the same
       # owner_id
-      if UNIQUE_FILE_ID_FRAME_RX.match(fid) and self[fid]:
+      if fid == UNIQUE_FILE_ID_FID and self[fid]:
           ufid_frames = self[fid];
           for frm in ufid_frames:
               if frm.owner_id == frame.owner_id:
@@ -1705,14 +2027,13 @@ class FrameSet(list):
       if not isinstance(fid, str):
          raise FrameException("removeFramesByID only operates on frame IDs");
 
-      i = 0;
-      count = 0;
-      while i < len(self):
-         if self[i].header.id == fid:
-            del self[i];
-            count += 1;
-         else:
-            i += 1;
+      if not self.frameMap.has_key(fid):
+         return 0;
+      count = len(self.frameMap[fid]);
+      del self.frameMap[fid];
+      list.__setslice__(self, 0, len(self),
+                        [f for f in list.__iter__(self)
+                           if f.header.id != fid]);
       return count;
 
    # Removes the frame at index.  True is returned if the element was
@@ -1722,9 +2043,9 @@ class FrameSet(list):
          raise\
            FrameException("removeFrameByIndex only operates on a frame index");
       try:
-         del self.frames[key];
+         del self[index];
          return 1;
-      except:
+      except IndexError:
          return 0;
 
    # Accepts both int (indexed access) and string keys (a valid frame Id).
@@ -1738,18 +2059,44 @@ class FrameSet(list):
    def __getitem__(self, key):
       if isinstance(key, int):
          if key >= 0 and key < len(self):
-            return list.__getitem__(self, key);
+            f = list.__getitem__(self, key);
+            if isinstance(f, LazyFrame):
+               f.decode();
+            return f;
          else:
             raise IndexError("FrameSet index out of range");
       elif isinstance(key, str):
-         retList = list();
-         for f in self:
-            if f.header.id == key:
-               retList.append(f);
+         retList = list(self.frameMap.get(key, ()));
+         for f in retList:
+            if isinstance(f, LazyFrame):
+               f.decode();
          return retList;
       else:
          raise TypeError("FrameSet key must be type int or string");
 
+   # Iteration goes through __getitem__ so lazily parsed frames are decoded
+   # before they are handed out.
+   def __iter__(self):
+      for i in xrange(len(self)):
+         yield self[i];
+
+NULL_RX = re.compile("\x00");
+UTF_16_DELIM_RX = re.compile("\x00\x00\x00");
+
+# Finds the end of the text in data starting at offset, using the same
+# delimiters as splitUnicode.  Returns the offset of the end of the text and
+# the offset of the data following it.  data may be a string or a buffer.
+def findTextEnd(data, encoding, offset = 0):
+    if encoding == UTF_16_ENCODING:
+        m = UTF_16_DELIM_RX.search(data, offset);
+        if m:
+            return (m.start() + 1, m.end());
+    else:
+        m = NULL_RX.search(data, offset);
+        if m:
+            return (m.start(), m.end());
+    raise FrameException("Text is not terminated");
+
 #  Mmmmm!  Cheesy!
 def splitUnicode(data, encoding):
     if encoding == LATIN1_ENCODING or encoding == UTF_8_ENCODING or\
@@ -1763,47 +2110,84 @@ def splitUnicode(data, encoding):
 #######################################################################
 # Create and return the appropriate frame.
 # Exceptions: ....
+# Frame classes for specific frame IDs; all other IDs are handled by prefix
+# (see getFrameClass).
+FRAME_CLASSES = {USERTEXT_FID : UserTextFrame,
+                 OBSOLETE_DATE_FID : DateFrame,
+                 OBSOLETE_YEAR_FID : DateFrame,
+                 OBSOLETE_ORIG_RELEASE_FID : DateFrame,
+                 COMMENT_FID : CommentFrame,
+                 USERURL_FID : UserURLFrame,
+                 CDID_FID : MusicCDIdFrame,
+                 IMAGE_FID : ImageFrame,
+                 PLAYCOUNT_FID : PlayCountFrame,
+                 UNIQUE_FILE_ID_FID : UniqueFileIDFrame};
+
+# Frame classes by ID prefix, longest first.
+FRAME_PREFIX_CLASSES = (("TD", DateFrame),
+                        ("T", TextFrame),
+                        ("W", URLFrame));
+
+# The class of the frame IDs seen so far, including unknown ones.  Corrupt
+# tags can yield any number of distinct junk IDs, so the cache stops growing
+# at FRAME_CLASS_CACHE_SIZE entries; the IDs in real use are seen long before.
+FRAME_CLASS_CACHE_SIZE = 256;
+frameClassCache = {};
+
+# Returns the class used to represent frames with the given ID; the result is
+# memoized so each ID is usually only examined once.
+def getFrameClass(fid):
+   try:
+      return frameClassCache[fid];
+   except KeyError:
+      pass;
+
+   cls = FRAME_CLASSES.get(fid);
+   if cls is None:
+      cls = UnknownFrame;
+      # Prefixed frames require an otherwise valid ID.
+      if FRAME_ID_RX.match(fid):
+         for prefix, prefixCls in FRAME_PREFIX_CLASSES:
+            if fid.startswith(prefix):
+               cls = prefixCls;
+               break;
+   if len(frameClassCache) < FRAME_CLASS_CACHE_SIZE:
+      frameClassCache[fid] = cls;
+   return cls;
+
+# Returns a dictionary mapping each frame ID named in frameIds (see
+# FrameSet.parse) to the indexes of the items of frameIds naming it.
+def groupFrameIds(frameIds):
+   frameGroups = {};
+   for i in range(len(frameIds)):
+      ids = frameIds[i];
+      if isinstance(ids, str):
+         ids = (ids,);
+      for fid in ids:
+         frameGroups.setdefault(fid, []).append(i);
+   return frameGroups;
+
 def createFrame(frameHeader, data):
-  f = None;
-
-  # Text Frames
-  if TEXT_FRAME_RX.match(frameHeader.id):
-     if USERTEXT_FRAME_RX.match(frameHeader.id):
-        f = UserTextFrame(frameHeader, data = data);
-     else:
-        if frameHeader.id[:2] == "TD" or\
-           frameHeader.id == OBSOLETE_DATE_FID or\
-           frameHeader.id == OBSOLETE_YEAR_FID or \
-           frameHeader.id == OBSOLETE_ORIG_RELEASE_FID:
-           f = DateFrame(frameHeader, data = data);
-        else:
-           f = TextFrame(frameHeader, data = data);
-  # Comment Frames.
-  elif COMMENT_FRAME_RX.match(frameHeader.id):
-     f = CommentFrame(frameHeader, data = data);
-  # URL Frames.
-  elif URL_FRAME_RX.match(frameHeader.id):
-     if USERURL_FRAME_RX.match(frameHeader.id):
-        f = UserURLFrame(frameHeader, data = data);
-     else:
-        f = URLFrame(frameHeader, data = data);
-  # CD Id frame.
-  elif CDID_FRAME_RX.match(frameHeader.id):
-     f = MusicCDIdFrame(frameHeader, data = data);
-  # Attached picture
-  elif IMAGE_FRAME_RX.match(frameHeader.id):
-     f = ImageFrame(frameHeader, data = data);
-  # Play count
-  elif PLAYCOUNT_FRAME_RX.match(frameHeader.id):
-     f = PlayCountFrame(frameHeader, data = data);
-  # Unique file identifier
-  elif UNIQUE_FILE_ID_FRAME_RX.match(frameHeader.id):
-     f = UniqueFileIDFrame(frameHeader, data = data);
-
-  if f == None:
-     f = UnknownFrame(frameHeader, data);
-
-  return f;
+  if utils.TRACE:
+     start = time.time();
+  cls = getFrameClass(frameHeader.id);
+
+  # Frame bodies parsed by FrameSet are buffers into the tag data.  Image
+  # frames take the buffer as is so the picture data is never copied.
+  if isinstance(data, buffer) and cls is not ImageFrame:
+     data = str(data);
+
+  if cls is UnknownFrame:
+     frame = UnknownFrame(frameHeader, data);
+  else:
+     frame = cls(frameHeader, data = data);
+
+  if utils.TRACE:
+     (fileName, offset) = frameHeader.dataLocation or (None, None);
+     TRACE_EVENT("frame", id = frameHeader.id, size = len(data),
+                 seconds = time.time() - start, file = fileName,
+                 offset = offset);
+  return frame;
 
 
 def map2_2FrameId(originalId):
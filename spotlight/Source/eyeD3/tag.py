@@ -17,8 +17,7 @@
 #  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 ################################################################################
-import re, os, string, stat, shutil, tempfile, binascii;
-import mimetypes;
+import re, os, string, stat, shutil, binascii;
 from stat import *;
 from eyeD3 import *;
 import eyeD3.utils;
@@ -111,9 +110,9 @@ class TagHeader:
       major = 2;
       minor = ord(version[0]);
       rev = ord(version[1]);
-      TRACE_MSG("TagHeader [major]: " + str(major));
-      TRACE_MSG("TagHeader [minor]: " + str(minor));
-      TRACE_MSG("TagHeader [revis]: " + str(rev));
+      TRACE_MSG("TagHeader [major]: %d", major);
+      TRACE_MSG("TagHeader [minor]: %d", minor);
+      TRACE_MSG("TagHeader [revis]: %d", rev);
       if not (major == 2 and (minor >= 2 and minor <= 4)):
          raise TagException("ID3 v" + str(major) + "." + str(minor) +\
                             " is not supported.");
@@ -124,21 +123,21 @@ class TagHeader:
       (self.unsync,
        self.extended,
        self.experimental,
-       self.footer) = bytes2bin(f.read(1))[0:4];
+       self.footer) = bytes2flags(f.read(1), (0, 1, 2, 3));
       TRACE_MSG("TagHeader [flags]: unsync(%d) extended(%d) "\
-                "experimental(%d) footer(%d)" % (self.unsync, self.extended,
-                                                 self.experimental,
-                                                 self.footer));
+                "experimental(%d) footer(%d)", self.unsync, self.extended,
+                self.experimental, self.footer);
 
       # The size of the optional extended header, frames, and padding
       # afer unsynchronization.  This is a sync safe integer, so only the
       # bottom 7 bits of each byte are used.
       tagSizeStr = f.read(4);
-      TRACE_MSG("TagHeader [size string]: 0x%02x%02x%02x%02x" %\
-                (ord(tagSizeStr[0]), ord(tagSizeStr[1]),
-                 ord(tagSizeStr[2]), ord(tagSizeStr[3])));
-      self.tagSize = bin2dec(bytes2bin(tagSizeStr, 7));
-      TRACE_MSG("TagHeader [size]: %d (0x%x)" % (self.tagSize, self.tagSize));
+      if eyeD3.utils.TRACE:
+         TRACE_MSG("TagHeader [size string]: 0x%02x%02x%02x%02x",
+                   ord(tagSizeStr[0]), ord(tagSizeStr[1]),
+                   ord(tagSizeStr[2]), ord(tagSizeStr[3]));
+      self.tagSize = synchsafe2int(tagSizeStr);
+      TRACE_MSG("TagHeader [size]: %d (0x%x)", self.tagSize, self.tagSize);
 
       return 1;
 
@@ -148,14 +147,10 @@ class TagHeader:
 
       data = "ID3";
       data += chr(self.minorVersion) + chr(self.revVersion);
-      # not not the values so we only get 1's and 0's.
-      data += bin2bytes([not not self.unsync,
-                         not not self.extended,
-                         not not self.experimental,
-                         not not self.footer,
-                         0, 0, 0, 0]);
-      TRACE_MSG("Setting tag size to %d" % tagLen);
-      szBytes = bin2bytes(bin2synchsafe(dec2bin(tagLen, 32)));
+      data += flags2bytes((self.unsync, self.extended, self.experimental,
+                           self.footer), (0, 1, 2, 3));
+      TRACE_MSG("Setting tag size to %d", tagLen);
+      szBytes = int2synchsafe(tagLen, 4);
       data += szBytes;
       TRACE_MSG("TagHeader Rendered");
       return data;
@@ -260,14 +255,14 @@ class ExtendedTagHeader:
          if self.hasCRC():
             data += "\x05";
             self.crc = binascii.crc32(data);
-            data += bin2bytes(dec2bin(self.crc, 40));
+            data += int2bytes(self.crc & 0xffffffffL, 5);
          if self.hasRestrictions():
             data += "\x01";
             assert(len(self.restrictions) == 1);
             data += self.restrictions;
 
          # Extended header size.
-         size = bin2bytes(bin2synchsafe(dec2bin(len(data) + 6, 32)))
+         size = int2synchsafe(len(data) + 6, 4);
          assert(len(size) == 4);
 
          assert(len(self.flags) == 2);
@@ -277,20 +272,17 @@ class ExtendedTagHeader:
          crc = None;
          size = 6;
          # Extended flags.
-         f = [0] * 16;
+         f = 0;
          if self.hasCRC():
-            f[0] = 1;
+            f = 0x8000;
             self.crc = binascii.crc32(data);
-            crc = bin2bytes(dec2bin(self.crc));
-            assert(len(crc) == 4);
+            crc = int2bytes(self.crc & 0xffffffffL, 4);
             size += 4;
-         flags = bin2bytes(f);
-         assert(len(flags) == 2);
+         flags = int2bytes(f, 2);
          # Extended header size.
-         size = bin2bytes(dec2bin(size, 32))
-         assert(len(size) == 4);
+         size = int2bytes(size, 4);
          # Padding size
-         paddingSize = bin2bytes(dec2bin(padding, 32));
+         paddingSize = int2bytes(padding, 4);
 
          data = size + flags + paddingSize;
          if crc:
@@ -306,8 +298,8 @@ class ExtendedTagHeader:
       if header.minorVersion == 4:
          TRACE_MSG("Parsing extended header for v2.4");
          # sync-safe
-         sz = bin2dec(bytes2bin(data, 7));
-         TRACE_MSG("Extended header size: %d" % (sz - 4));
+         sz = synchsafe2int(data);
+         TRACE_MSG("Extended header size: %d", sz - 4);
          data = fp.read(sz - 4);
 
          if ord(data[0]) != 1 or (ord(data[1]) & 0x8f):
@@ -317,7 +309,7 @@ class ExtendedTagHeader:
 
          offset = 2;
          self.flags = ord(data[1]);
-         TRACE_MSG("Extended header flags: %x" % self.flags);
+         TRACE_MSG("Extended header flags: %x", self.flags);
 
          if self.isUpdate():
             TRACE_MSG("Extended header has update bit set");
@@ -329,8 +321,8 @@ class ExtendedTagHeader:
             offset += 1;
             crcData = data[offset:offset + 5];
             # This is sync-safe.
-            self.crc = bin2dec(bytes2bin(crcData, 7));
-            TRACE_MSG("Extended header CRC: %d" % self.crc);
+            self.crc = synchsafe2int(crcData);
+            TRACE_MSG("Extended header CRC: %d", self.crc);
             offset += 5;
          if self.hasRestrictions():
             TRACE_MSG("Extended header has restrictions bit set");
@@ -341,8 +333,8 @@ class ExtendedTagHeader:
       else:
          TRACE_MSG("Parsing extended header for v2.3");
          # v2.3 is totally different... *sigh*
-         sz = bin2dec(bytes2bin(data));
-         TRACE_MSG("Extended header size: %d" % sz);
+         sz = bytes2int(data);
+         TRACE_MSG("Extended header size: %d", sz);
          data = fp.read(sz);
          tmpFlags = fp.read(2);
          # Make this look like a v2.4 mask.
@@ -350,8 +342,8 @@ class ExtendedTagHeader:
          if self.hasCRC():
             TRACE_MSG("Extended header has CRC bit set");
             crcData = fp.read(4);
-            self.crc = bin2dec(bytes2bin(crcData));
-            TRACE_MSG("Extended header CRC: %d" % self.crc);
+            self.crc = bytes2int(crcData);
+            TRACE_MSG("Extended header CRC: %d", self.crc);
          # Read the padding size, but it'll be computed during the parse.
          fp.read(4);
 
@@ -380,6 +372,10 @@ class Tag:
    # If this value is None the tag is not linked to any particular file..
    linkedFile = None;
 
+   # True when link() read only a subset of the frames; such a tag can not
+   # be written back to the file.
+   partial = 0;
+
    # Constructor.  An empty tag is created and the link method is used
    # to read an mp3 file's v1.x or v2.x tag.  You can optionally set a 
    # file name, but it will not be read, but may be written to.
@@ -420,14 +416,28 @@ class Tag:
    #
    # Converts all ID3v1 data into ID3v2 frames internally.
    # May throw IOError, or TagException if parsing fails.
-   def link(self, f, v = ID3_ANY_VERSION):
+   #
+   # Passing lazy = 1 defers decoding each v2 frame body until the frame is
+   # first accessed, which is much cheaper when only a few frames are read.
+   # Errors in a frame body are then raised as a FrameException on access.
+   #
+   # frameIds may be a list of the v2.3/v2.4 frame IDs of interest (v2.2 IDs
+   # are mapped to these), or of tuples of alternative IDs.  Only those v2
+   # frames are read; the bodies of all others are seeked past and reading
+   # stops once each ID, or one ID of each tuple, has been found.
+   # The resulting tag is marked partial and can not be updated.
+   def link(self, f, v = ID3_ANY_VERSION, lazy = 0, frameIds = None):
       self.clear();
+      self.partial = frameIds is not None;
 
       fileName = "";
       if isinstance(f, file):
          fileName = f.name;
       elif isinstance(f, str):
          fileName = f;
+      elif hasattr(f, "read"):
+         # Any file-like object, such as an eyeD3.utils.WindowFile.
+         fileName = getattr(f, "name", "");
       else:
          raise TagException("Invalid type passed to Tag.link: " + 
                             str(type(f)));
@@ -435,26 +445,44 @@ class Tag:
       if v != ID3_V1 and v != ID3_V2 and v != ID3_ANY_VERSION:
          raise TagException("Invalid version: " + hex(v));
 
+      # A named file is opened once for both the v2 and v1 tags.
+      if isinstance(f, str):
+         fp = eyeD3.utils.WindowFile(f);
+         try:
+            return self.__link(fp, fileName, v, lazy, frameIds);
+         finally:
+            fp.close();
+      return self.__link(f, fileName, v, lazy, frameIds);
+
+   def __link(self, f, fileName, v, lazy, frameIds):
       tagFound = 0;
       padding = 0;
-      TRACE_MSG("Linking File: " + fileName);
+      # Remains None if the file is not searched for a v2 tag.
+      v2TagSize = None;
+      TRACE_MSG("Linking File: %s", fileName);
       if v == ID3_V1:
          if self.__loadV1Tag(f):
             tagFound = 1;
       elif v == ID3_V2:
-         padding = self.__loadV2Tag(f);
+         padding = self.__loadV2Tag(f, lazy, frameIds);
          if padding >= 0:
             tagFound = 1;
+            v2TagSize = self.header.tagSize;
       elif v == ID3_ANY_VERSION:
-         padding = self.__loadV2Tag(f);
+         padding = self.__loadV2Tag(f, lazy, frameIds);
          if padding >= 0:
             tagFound = 1;
+            v2TagSize = self.header.tagSize;
          else:
             padding = 0;
             if self.__loadV1Tag(f):
                tagFound = 1;
 
+      if v2TagSize is None and v != ID3_V1:
+         v2TagSize = 0;
+
       self.linkedFile = LinkedFile(fileName);
+      self.linkedFile.v2TagSize = v2TagSize;
       if tagFound:
          # In the case of a v1.x tag this is zero.
          self.linkedFile.tagSize = self.header.tagSize;
@@ -470,6 +498,9 @@ class Tag:
    def update(self, version = ID3_CURRENT_VERSION, backup = 0):
       if not self.linkedFile:
          raise TagException("The Tag is not linked to a file.");
+      if self.partial:
+         raise TagException("The Tag was linked with a subset of its frames "\
+                            "and can not be updated.");
 
       if backup:
          shutil.copyfile(self.linkedFile.name, self.linkedFile.name + ".orig");
@@ -508,7 +539,11 @@ class Tag:
    # ID3 tag versions; the default is ID3_CURRENT_VERSION meaning the version
    # of the current tag.  A value of ID3_ANY_VERSION causes all tags to be
    # removed.
-   def remove(self, version = ID3_CURRENT_VERSION):
+   #
+   # Removing a v2 tag means copying the rest of the file; progress may be a
+   # function which is called as the copy proceeds with the number of bytes
+   # copied so far and the total.
+   def remove(self, version = ID3_CURRENT_VERSION, progress = None):
       if not self.linkedFile:
          raise TagException("The Tag is not linked to a file; nothing to "\
                             "remove.");
@@ -516,6 +551,11 @@ class Tag:
       if version == ID3_CURRENT_VERSION:
          version = self.getVersion();
 
+      # Image data which is still in the file must be read before the file
+      # changes.
+      for f in self.frames[IMAGE_FID]:
+         f.imageData;
+
       retval = 0;   
       if version & ID3_V1 or version == ID3_ANY_VERSION:
          tagFile = file(self.linkedFile.name, "r+b");
@@ -529,16 +569,17 @@ class Tag:
 
       if ((version & ID3_V2) or (version == ID3_ANY_VERSION)) and\
           self.header.tagSize:
-         tagFile = file(self.linkedFile.name, "r+b");
-         if tagFile.read(3) == "ID3":
+         tagFile = file(self.linkedFile.name, "rb");
+         isTagged = tagFile.read(3) == "ID3";
+         tagFile.close();
+         if isTagged:
             TRACE_MSG("Removing ID3 v2.x Tag");
+            # The audio is copied to a new file in blocks rather than read
+            # into memory.
             tagSize = self.header.tagSize + self.header.SIZE;
-            tagFile.seek(tagSize);
-            data = tagFile.read();
-            tagFile.seek(0);
-            tagFile.write(data);
-            tagFile.truncate();
-            tagFile.close();
+            eyeD3.utils.rewriteFile(self.linkedFile.name, "", tagSize,
+                                    progress);
+            self.linkedFile.v2TagSize = 0;
             retval |= 1;
 
       return retval;
@@ -1039,22 +1080,22 @@ class Tag:
             self.setVersion(ID3_V1_0);
 
             title = re.sub("\x00+$", "", id3tag[3:33].strip(strip_chars));
-            TRACE_MSG("Tite: " + title);
+            TRACE_MSG("Tite: %s", title);
             if title:
                self.setTitle(unicode(title, "latin1"));
 
             artist = re.sub("\x00+$", "", id3tag[33:63].strip(strip_chars));
-            TRACE_MSG("Artist: " + artist);
+            TRACE_MSG("Artist: %s", artist);
             if artist:
                self.setArtist(unicode(artist, "latin1"));
 
             album = re.sub("\x00+$", "", id3tag[63:93].strip(strip_chars));
-            TRACE_MSG("Album: " + album);
+            TRACE_MSG("Album: %s", album);
             if album:
                self.setAlbum(unicode(album, "latin1"));
 
             year = re.sub("\x00+$", "", id3tag[93:97].strip(strip_chars));
-            TRACE_MSG("Year: " + year);
+            TRACE_MSG("Year: %s", year);
             try:
                if year and int(year):
                   self.setDate(year);
@@ -1064,26 +1105,26 @@ class Tag:
 
             if re.sub("\x00+$", "", id3tag[97:127]):
                comment = id3tag[97:127];
-               TRACE_MSG("Comment: " + comment);
+               TRACE_MSG("Comment: %s", comment);
                if comment[-2] == "\x00" and comment[-1] != "\x00":
                   # Parse track number (added to ID3v1.1) if present.
                   TRACE_MSG("Comment contains track number per v1.1 spec");
                   track = ord(comment[-1]);
                   self.setTrackNum((track, None));
-                  TRACE_MSG("Track: " + str(track));
+                  TRACE_MSG("Track: %s", track);
                   TRACE_MSG("Track Num found, setting version to v1.1s");
                   self.setVersion(ID3_V1_1);
                   comment = comment[:-2];
                else:
                   track = None
                comment = re.sub("\x00+$", "", comment).rstrip();
-               TRACE_MSG("Comment: " + comment);
+               TRACE_MSG("Comment: %s", comment);
                if comment:
                   self.addComment(unicode(comment, 'latin1'),
                                   ID3_V1_COMMENT_DESC);
 
             genre = ord(id3tag[127:128])
-            TRACE_MSG("Genre ID: " + str(genre));
+            TRACE_MSG("Genre ID: %s", genre);
             self.setGenre(genre);
 
       if closeFile:
@@ -1092,22 +1133,25 @@ class Tag:
 
    def __saveV2Tag(self, version):
       assert(version & ID3_V2);
-      TRACE_MSG("Rendering tag version: " + versionToString(version));
+      TRACE_MSG("Rendering tag version: %s", versionToString(version));
 
       self.setVersion(version);
 
-      currPadding = 0;
-      currTagSize = 0
-      if currTagSize == 0:
+      currTagSize = self.linkedFile.v2TagSize;
+      if currTagSize is None:
          # We may be converting from 1.x to 2.x so we need to find any
-         # current v2.x tag otherwise we're gonna hork the file.
-         tmpTag = Tag();
-         if tmpTag.link(self.linkedFile.name, ID3_V2):
-            TRACE_MSG("Found current v2.x tag:");
-            currTagSize = tmpTag.linkedFile.tagSize;
-            TRACE_MSG("Current tag size: %d" % currTagSize);
-            currPadding = tmpTag.linkedFile.tagPadding;
-            TRACE_MSG("Current tag padding: %d" % currPadding);
+         # current v2.x tag otherwise we're gonna hork the file.  Only its
+         # header is needed.
+         currTagSize = 0;
+         tmpHeader = TagHeader();
+         tagFile = file(self.linkedFile.name, "rb");
+         try:
+            if tmpHeader.parse(tagFile):
+               TRACE_MSG("Found current v2.x tag:");
+               currTagSize = tmpHeader.tagSize;
+         finally:
+            tagFile.close();
+      TRACE_MSG("Current tag size: %d", currTagSize);
 
       # Tag it!
       if self.header.minorVersion == 4:
@@ -1120,19 +1164,19 @@ class Tag:
           self.frames.addFrame(dateFrame);
 
       # Render all frames first so the data size is known for the tag header.
-      frameData = "";
-      for f in self.frames:
-         TRACE_MSG("Rendering frame: " + f.header.id);
-         raw_frame = f.render();
-         TRACE_MSG("Rendered %d bytes" % len(raw_frame));
-         frameData += raw_frame;
+      # Frames which have not changed since they were last rendered (or, if
+      # they were parsed lazily, since they were read) are not rendered
+      # again.
+      frameData = "".join(self.frames.render());
+      # Rendering may convert frame IDs between versions.
+      self.frames.reindex();
       # Handle the overall tag header unsync bit.  Frames themselves duplicate
       # this bit.
       if self.header.unsync:
           TRACE_MSG("Unsyncing all frames (sync-safe)");
           frameData = frames.unsyncData(frameData);
 
-      TRACE_MSG("Rendered tag size: " + str(len(frameData)));
+      TRACE_MSG("Rendered tag size: %d", len(frameData));
 
       rewriteFile = 0;
       paddingSize = 0;
@@ -1158,49 +1202,47 @@ class Tag:
       frameData += ("\x00" * paddingSize);
 
       # Render the tag header.
-      TRACE_MSG("Rendering %s tag header with size %d" %\
-                (versionToString(self.getVersion()), len(frameData)));
+      if eyeD3.utils.TRACE:
+         TRACE_MSG("Rendering %s tag header with size %d",
+                   versionToString(self.getVersion()), len(frameData));
       headerData = self.header.render(len(frameData));
 
       # Assemble frame.
       tagData = headerData + frameData;
 
+      # Image data which is still in the file must be read before the file
+      # changes.
+      for f in self.frames:
+         if isinstance(f, ImageFrame):
+            f.imageData;
+
       # Write the tag.
       if not rewriteFile:
          tagFile = file(self.linkedFile.name, "r+b");
-         TRACE_MSG("Writing %d bytes of tag data" % len(tagData));
+         TRACE_MSG("Writing %d bytes of tag data", len(tagData));
          tagFile.write(tagData);
          tagFile.close();
       else:
-         # Open original
-         tagFile = file(self.linkedFile.name, "rb");
-         # Read all audio data
-         tagFile.seek(currTagSize);
-         audioData = tagFile.read();
-         tagFile.close();
-
-         # Open tmp file
-         tmpName = tempfile.mktemp();
-         tmpFile = file(tmpName, "w+b");
-         TRACE_MSG("Writing %d bytes of tag data" % len(tagData));
-         tmpFile.write(tagData);
-         tmpFile.write(audioData);
-         tmpFile.close();
-
-         # Move tmp to orig.
-         shutil.copyfile(tmpName, self.linkedFile.name);
-         os.unlink(tmpName);
-
-      # Update our state.
+         # Replace the current tag, including its header, with the new one.
+         if currTagSize:
+            currTagSize += TagHeader.SIZE;
+         TRACE_MSG("Writing %d bytes of tag data", len(tagData));
+         eyeD3.utils.rewriteFile(self.linkedFile.name, tagData, currTagSize);
+
+      # Update our state.  Frames which were never decoded no longer refer
+      # to their old place in the file.
       TRACE_MSG("Tag write complete.  Updating state.");
+      for f in self.frames:
+         if isinstance(f, LazyFrame):
+            f.detach();
       self.linkedFile.tagPadding = paddingSize;
-      # XXX: getSize could cache sizes so to prevent rendering again.
-      self.linkedFile.tagSize = self.frames.getSize();
+      self.linkedFile.tagSize = len(tagData) - TagHeader.SIZE;
+      self.linkedFile.v2TagSize = self.linkedFile.tagSize;
 
 
    # Returns >= 0 to indicate the padding size of the read frame; -1 returned
    # when not tag was found.
-   def __loadV2Tag(self, f):
+   def __loadV2Tag(self, f, lazy = 0, frameIds = None):
       if isinstance(f, str):
          fp = file(f, "rb")
          closeFile = 1;
@@ -1220,8 +1262,15 @@ class Tag:
 
          # Header is definitely there so at least one frame *must* follow.
          self.frames.setTagHeader(self.header);
-         padding = self.frames.parse(fp, self.header);
-         TRACE_MSG("Tag contains %d bytes of padding." % padding);
+         if eyeD3.utils.TRACE:
+            start = time.time();
+         padding = self.frames.parse(fp, self.header, lazy, frameIds);
+         if eyeD3.utils.TRACE:
+            TRACE_MSG("Tag contains %d bytes of padding.", padding);
+            TRACE_EVENT("tag", file = getattr(fp, "name", None),
+                        version = versionToString(self.header.version),
+                        size = self.header.tagSize, frames = len(self.frames),
+                        padding = padding, seconds = time.time() - start);
       except FrameException, ex:
          fp.close();
          raise TagException(str(ex));
@@ -1452,20 +1501,34 @@ class TagFile:
 class Mp3AudioFile(TagFile):
    header         = mp3.Header();
    xingHeader     = None;
+   vbriHeader     = None;
    invalidFileExc = InvalidAudioFormatException("File is not mp3");
    # Number of seconds required to play the audio file.
    playTime       = None;
 
-   def __init__(self, fileName, tagVersion = ID3_ANY_VERSION):
+   # durationMode selects how playTime is computed when there is no Xing or
+   # VBRI header; see the DURATION_ constants in eyeD3.mp3 for the choices
+   # and their costs.  The default is eyeD3.mp3.DEFAULT_DURATION_MODE.
+   def __init__(self, fileName, tagVersion = ID3_ANY_VERSION,
+                durationMode = None):
       TagFile.__init__(self, fileName);
+      if durationMode is None:
+         durationMode = mp3.DEFAULT_DURATION_MODE;
+      if durationMode not in mp3.DURATION_MODES:
+         raise ValueError("Invalid duration mode: " + str(durationMode));
 
       self.playTime = None;
 
-      if not isMp3File(fileName):
+      # The file is opened once; the bytes used to identify it are reused
+      # to parse the tag and find the first frame, and the v1 tag is read
+      # with the end of the file (see WindowFile).
+      f = eyeD3.utils.WindowFile(fileName);
+      self.fileSize = f.size;
+      if not isMp3File(fileName, f.head[:SNIFF_SIZE]):
+         f.close();
          raise self.invalidFileExc;
 
       # Parse ID3 tag.
-      f = file(fileName, "rb");
       tag = Tag();
       hasTag = tag.link(f, tagVersion);
       # Find the first mp3 frame.
@@ -1478,59 +1541,74 @@ class Mp3AudioFile(TagFile):
          # XXX: Note that v2.4 allows for appended tags; account for that.
          framePos = tag.header.SIZE + tag.header.tagSize;
 
-      # XXX: This algorithm is slow, if the file is long it could take awhile.
-      f.seek(framePos);
-      bString = f.read(4);
-      if len(bString) < 4:
+      (headerPos, frameHead) = mp3.findHeader(f, framePos);
+      if headerPos is None:
          raise InvalidAudioFormatException("Unable to find a valid mp3 "\
                                            "frame");
-      frameHead = bin2dec(bytes2bin(bString));
-      header = mp3.Header();
-      # Keep reading until we find a valid mp3 frame header.
-      while not header.isValid(frameHead):
-         frameHead <<= 8;
-         bString = f.read(1);
-         if len(bString) != 1:
-            raise InvalidAudioFormatException("Unable to find a valid mp3 "\
-                                              "frame");
-         frameHead |= ord(bString[0]);
-      TRACE_MSG("mp3 header %x found at position: %d (0x%x)" % \
-                (frameHead, f.tell() - 4, f.tell() - 4));
+      TRACE_MSG("mp3 header %x found at position: %d (0x%x)", frameHead,
+                headerPos, headerPos);
 
       # Decode the header.
+      header = mp3.Header();
       try:
          header.decode(frameHead);
          # Check for Xing header inforamtion which will always be in the
          # first "null" frame.
-         f.seek(-4, 1);
+         f.seek(headerPos);
          mp3Frame = f.read(header.frameLength);
+         vbriHeader = None;
          if mp3Frame.find("Xing") != -1:
             xingHeader = mp3.XingHeader();
             if not xingHeader.decode(mp3Frame):
                raise InvalidAudioFormatException("Corrupt Xing header");
          else:
             xingHeader = None;
+            vbriHeader = mp3.VbriHeader();
+            if not vbriHeader.decode(mp3Frame):
+               vbriHeader = None;
       except mp3.Mp3Exception, ex:
          raise InvalidAudioFormatException(str(ex));
 
       # Compute track play time.
       tpf = mp3.computeTimePerFrame(header);
-      if xingHeader:
+      if durationMode != mp3.DURATION_ESTIMATE and\
+         (durationMode == mp3.DURATION_EXACT or\
+          not (xingHeader or vbriHeader)):
+         # The audio starts after the Xing or VBRI frame, which carries no
+         # audio, and ends at the v1 tag, if there is one.
+         audioStart = headerPos;
+         if xingHeader or vbriHeader:
+            audioStart += header.frameLength;
+         audioEnd = self.getSize();
+         if f.size >= 128:
+            f.seek(-128, 2);
+            if f.read(3) == "TAG":
+               audioEnd -= 128;
+         if durationMode == mp3.DURATION_EXACT:
+            seconds = mp3.walkFrames(f, audioStart, audioEnd)[1];
+         else:
+            seconds = mp3.sampleDuration(f, audioStart, audioEnd);
+         self.playTime = int(seconds);
+      elif xingHeader:
          self.playTime = int(tpf * xingHeader.numFrames);
+      elif vbriHeader:
+         self.playTime = int(tpf * vbriHeader.numFrames);
       else:
          length = self.getSize();
          if tag and tag.isV2():
             length -= tag.header.SIZE + tag.header.tagSize;
             # Handle the case where there is a v2 tag and a v1 tag.
-            f.seek(-128, 2)
-            if f.read(3) == "TAG":
-               length -= 128;
+            if f.size >= 128:
+               f.seek(-128, 2)
+               if f.read(3) == "TAG":
+                  length -= 128;
          elif tag and tag.isV1():
             length -= 128;
          self.playTime = int((length / header.frameLength) * tpf);    
 
       self.header = header;
       self.xingHeader = xingHeader;
+      self.vbriHeader = vbriHeader;
       self.tag = tag;
       f.close();
 
@@ -1551,7 +1629,7 @@ class Mp3AudioFile(TagFile):
    # Returns a tuple.  The first value is a boolean which if true means the
    # bit rate returned in the second value is variable.
    def getBitRate(self):
-      xHead = self.xingHeader;
+      xHead = self.xingHeader or self.vbriHeader;
       if xHead:
          tpf = eyeD3.mp3.computeTimePerFrame(self.header);
          br = int((xHead.numBytes * 8) / (tpf * xHead.numFrames * 1000));
@@ -1571,7 +1649,32 @@ class Mp3AudioFile(TagFile):
       return self.header.sampleFreq;
 
 ################################################################################
-def isMp3File(fileName):
+# The number of leading bytes examined to identify a file.
+SNIFF_SIZE = 4096;
+
+# Returns true if data, the leading bytes of a file, start with an ID3 v2 tag
+# or an mp3 frame header.
+def isMp3Data(data):
+    if data[0:3] == "ID3":
+        return 1;
+    if len(data) < 4:
+        return 0;
+    frameHead = (ord(data[0]) << 24) | (ord(data[1]) << 16) |\
+                (ord(data[2]) << 8) | ord(data[3]);
+    return mp3.Header().isValid(frameHead);
+
+# The file contents are checked first; the file name is only used when they
+# are inconclusive (e.g. junk before the first mp3 frame).  head may be passed
+# when the leading bytes of the file have already been read.
+def isMp3File(fileName, head = None):
+    if head is None:
+        f = file(fileName, "rb");
+        head = f.read(4);
+        f.close();
+    if isMp3Data(head):
+        return 1;
+    # Imported here since it is rarely needed and loads urllib.
+    import mimetypes;
     (type, enc) = mimetypes.guess_type(fileName);
     return type == "audio/mpeg";
 
@@ -1779,6 +1882,10 @@ class LinkedFile:
    name = "";
    tagPadding = 0;
    tagSize = 0;  # This includes the padding byte count.
+   # The size of the v2 tag at the start of the file, as tagSize, or 0 if
+   # there is none.  None when the file has not been searched for one (the
+   # tag was linked as v1), in which case saving a v2 tag has to look.
+   v2TagSize = None;
 
    def __init__(self, fileName):
       self.name = fileName;
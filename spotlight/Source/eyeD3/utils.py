@@ -17,6 +17,7 @@
 #
 #  $Id$
 ################################################################################
+import os, stat, tempfile;
 from eyeD3 import *;
 
 def versionsToConstant(v):
@@ -79,16 +80,216 @@ def constantToVersions(v):
    raise str("constantToVersions - Invalid ID3 version constant: %s" % hex(v));
 
 ################################################################################
-TRACE = 0;
+# Trace levels.  TRACE holds the current level; at TRACE_EVENTS only the
+# events passed to TRACE_EVENT are written, at TRACE_DEBUG the messages passed
+# to TRACE_MSG are too.  Call sites on hot paths test utils.TRACE before
+# building anything to trace, so tracing costs one flag check when it is off.
+#
+# Note that TRACE used to be a simple switch: setting it to 1 now gives
+# TRACE_EVENTS, and the debug messages it used to print need TRACE_DEBUG.
+TRACE_OFF = 0;
+TRACE_EVENTS = 1;
+TRACE_DEBUG = 2;
+TRACE = TRACE_OFF;
 prefix = "eyeD3 trace> ";
-def TRACE_MSG(msg):
-   if TRACE:
+
+# Prints msg at the debug level.  When args are given msg is a format string
+# and is only formatted if the message is printed.
+def TRACE_MSG(msg, *args):
+   if TRACE >= TRACE_DEBUG:
        try:
+           if args:
+               msg = msg % args;
            print prefix + msg;
        except UnicodeEncodeError:
            pass;
 
+# Emits the event named event, with the values given as keyword arguments, at
+# the events level.  Events are passed to traceHandler as the name and a
+# dictionary of values; the default handler prints them one per line as
+# name=value pairs.  Replace it to collect events instead, for instance to
+# total the time spent decoding each frame ID over many files.
+#
+# Events emitted by eyeD3:
+#   frame - id, size (bytes of frame data), seconds (to decode), and file and
+#           offset when the frame was read from a file.
+#   tag   - file, version, size (bytes of frames and padding), frames,
+#           padding and seconds (to parse the frames).
+def TRACE_EVENT(event, **values):
+   if TRACE >= TRACE_EVENTS:
+      traceHandler(event, values);
+
+def printTraceEvent(event, values):
+   names = values.keys();
+   names.sort();
+   print prefix + event + "".join([" %s=%r" % (n, values[n])
+                                   for n in names]);
+
+traceHandler = printTraceEvent;
+
 STRICT_ID3 = 0;
 def strictID3():
    return STRICT_ID3;
 
+################################################################################
+# The sizes of the windows at the start and end of a file kept by WindowFile.
+# The head window holds the tags of most files and their first audio frames,
+# the tail window the ID3 v1 tag and APE tag footer.
+HEAD_WINDOW_SIZE = 16 * 1024;
+TAIL_WINDOW_SIZE = 4 * 1024;
+
+# A read-only file object which serves reads near the start and the end of a
+# file from two windows, each fetched with a single read.  Parsing the v2 tag,
+# the v1 tag and the first mp3 frame of a file then opens it once and costs
+# about two reads, however many seeks the parsers make; this matters most on
+# network file systems, where every read is a round trip.  Reads outside the
+# windows go straight to the file.
+#
+# The tail window is only read when first needed.  The file may be given as a
+# name or as an open file object whose first bytes, head, have already been
+# read (to identify its type, for example); they are then used as the head
+# window.
+#
+# Reads are positioned with lseek and read on the file descriptor, as Python
+# has no pread, and bypass the file object's buffering.
+class WindowFile:
+   def __init__(self, f, head = None, headSize = HEAD_WINDOW_SIZE,
+                tailSize = TAIL_WINDOW_SIZE):
+      if isinstance(f, str):
+         f = file(f, "rb");
+      self.fp = f;
+      self.fd = f.fileno();
+      self.name = getattr(f, "name", "");
+      self.size = os.fstat(self.fd).st_size;
+      self.pos = 0;
+
+      if head is None:
+         head = self.pread(0, headSize);
+      self.head = head;
+      self.tailStart = max(self.size - tailSize, len(head));
+      self.tail = None;
+
+   # Read size bytes from offset in the file, ignoring the windows.
+   def pread(self, offset, size):
+      os.lseek(self.fd, offset, 0);
+      chunks = [];
+      while size > 0:
+         data = os.read(self.fd, size);
+         if not data:
+            break;
+         chunks.append(data);
+         size -= len(data);
+      return "".join(chunks);
+
+   def read(self, size = -1):
+      if size < 0 or self.pos + size > self.size:
+         size = max(self.size - self.pos, 0);
+
+      chunks = [];
+      while size > 0:
+         pos = self.pos;
+         if pos < len(self.head):
+            data = self.head[pos:pos + size];
+         elif pos >= self.tailStart:
+            if self.tail is None:
+               self.tail = self.pread(self.tailStart,
+                                      self.size - self.tailStart);
+            start = pos - self.tailStart;
+            data = self.tail[start:start + size];
+         else:
+            data = self.pread(pos, min(size, self.tailStart - pos));
+         if not data:
+            break;
+         chunks.append(data);
+         self.pos += len(data);
+         size -= len(data);
+      return "".join(chunks);
+
+   def seek(self, offset, whence = 0):
+      if whence == 0:
+         self.pos = offset;
+      elif whence == 1:
+         self.pos += offset;
+      else:
+         self.pos = self.size + offset;
+      if self.pos < 0:
+         raise IOError(22, "Invalid argument");
+
+   def tell(self):
+      return self.pos;
+
+   def fileno(self):
+      return self.fd;
+
+   def close(self):
+      self.fp.close();
+
+################################################################################
+# Size of the blocks used when copying data between files, so that copying
+# large files (or pictures) needs only a bounded amount of memory.
+COPY_BLOCK_SIZE = 256 * 1024;
+
+# Copy size bytes (or all the remaining data, when size is negative) from the
+# current position of the file object src to dst.  Returns the number of bytes
+# copied, which is less than size if src ends first.  If progress is given it
+# is called after each block with the number of bytes copied so far and size.
+def copyData(src, dst, size = -1, blockSize = COPY_BLOCK_SIZE,
+             progress = None):
+   copied = 0;
+   while size < 0 or copied < size:
+      if size < 0:
+         n = blockSize;
+      else:
+         n = min(blockSize, size - copied);
+      data = src.read(n);
+      if not data:
+         break;
+      dst.write(data);
+      copied += len(data);
+      if progress:
+         progress(copied, size);
+   return copied;
+
+# Replace the first size bytes of the file fileName with data.  The new
+# contents are written to a temporary file in the same directory, copying the
+# rest of the original in blocks, which is then renamed over the original.  So
+# the data is written once, memory use is bounded, and should anything fail
+# the original file is left as it was.  The file's permissions are kept but
+# its ownership, as with any new file, is that of the current user.
+#
+# progress, if given, is called as the original is copied with the number of
+# bytes copied so far and the total to copy.
+def rewriteFile(fileName, data, size, progress = None):
+   # Replace the file a symbolic link points to rather than the link.
+   fileName = os.path.realpath(fileName);
+   (fd, tmpName) = tempfile.mkstemp(".tmp", os.path.basename(fileName) + ".",
+                                    os.path.dirname(fileName));
+   try:
+      tmpFile = os.fdopen(fd, "wb");
+      try:
+         tmpFile.write(data);
+         src = file(fileName, "rb");
+         try:
+            src.seek(size);
+            total = max(os.fstat(src.fileno()).st_size - size, 0);
+            copyData(src, tmpFile, total, progress = progress);
+         finally:
+            src.close();
+         tmpFile.flush();
+         os.fsync(tmpFile.fileno());
+      finally:
+         tmpFile.close();
+
+      os.chmod(tmpName, stat.S_IMODE(os.stat(fileName).st_mode));
+      try:
+         os.rename(tmpName, fileName);
+      except OSError:
+         # Windows will not rename over an existing file.
+         if os.name != "nt":
+            raise;
+         os.unlink(fileName);
+         os.rename(tmpName, fileName);
+   except:
+      if os.path.exists(tmpName):
+         os.unlink(tmpName);
+      raise;
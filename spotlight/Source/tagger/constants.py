@@ -13,6 +13,10 @@ ID3_FILE_NEW = 2
 ID3V2_FILE_HEADER_LENGTH = 10
 ID3V2_FILE_EXTHEADER_LENGTH = 5
 ID3V2_FILE_DEFAULT_PADDING = 512
+# fraction of its size added as padding when a tag is rewritten
+ID3V2_FILE_PADDING_FRACTION = 0.1
+# block size used to copy the audio when a tag is rewritten
+ID3V2_FILE_COPY_BLOCK_SIZE = 256 * 1024
 
 ID3V2_DEFAULT_VERSION = 2.4
 
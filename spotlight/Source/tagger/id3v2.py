@@ -14,7 +14,23 @@ from tagger.utility import *
 from tagger.debug import *
 
 
-import os, struct, sys, types, tempfile, math
+import os, re, stat, struct, sys, types, tempfile, math
+
+# a run of padding
+NULL_BYTES_RX = re.compile('\x00*')
+
+def default_padding(size):
+	"""
+	Default padding policy: leave room for the tag to grow by a tenth, and
+	at least ID3V2_FILE_DEFAULT_PADDING bytes, so that later edits can be
+	written in place.
+
+	@param size: size of the frames and extension header being written
+	@type size: int
+	@rtype: int
+	"""
+	return max(ID3V2_FILE_DEFAULT_PADDING,
+			   int(size * ID3V2_FILE_PADDING_FRACTION))
 
 class ID3v2:
 	"""
@@ -49,7 +65,7 @@ class ID3v2:
 	supported = [2.2, 2.3, 2.4]
 	
 	def __init__(self, filename, mode=ID3_FILE_READ, \
-				 version=ID3V2_DEFAULT_VERSION):
+				 version=ID3V2_DEFAULT_VERSION, padding_policy=default_padding):
 		"""
 		@param filename: the file to open or write to.
 		@type filename: string
@@ -60,6 +76,9 @@ class ID3v2:
 		@param version: if ID3_FILE_NEW, then what version to create the header in. Default is 2.4
 		@type version: float
 
+		@param padding_policy: called with the size of the frames and extension header when the tag has to be rewritten, returns the padding to add. Default is default_padding.
+		@type padding_policy: callable
+
 		@raise ID3Exception: if file does not have an ID3v2 but is specified
 		to be in read or modify mode.
 		"""
@@ -77,6 +96,7 @@ class ID3v2:
 			
 		self.mode = mode
 		self.filename = filename
+		self.padding_policy = padding_policy
 
 		if mode in [ID3_FILE_READ, ID3_FILE_MODIFY]:
 			self.parse_header()
@@ -122,17 +142,11 @@ class ID3v2:
 	def set_version(self, version):
 		self.version = version
 
-	def _read_null_bytes(self):
+	def _read_null_bytes(self, data, offset):
 		"""
-		Count the number of null bytes at the specified file pointer
+		Count the number of null bytes in data starting at offset
 		"""
-		nullbuffer = 0
-		while 1:
-			if self.f.read(1) == '\x00':
-				nullbuffer += 1
-			else:
-				break
-		return nullbuffer
+		return NULL_BYTES_RX.match(data, offset).end() - offset
 
 	def __seek_to_sync(self):
 		"""
@@ -275,12 +289,21 @@ class ID3v2:
 		return 0 # FIXME
     
 	def parse_frames(self):
-		""" Recursively Parse Frames """
+		"""
+		Parse Frames
+
+		The rest of the tag is read in one call and the frames and padding
+		are parsed from memory.
+		"""
 		read = 0
 		readframes = 0
-		
-		while read < self.tag["size"]:
-			framedata = self.get_next_frame(self.tag["size"] - read)
+
+		# the extended header, if any, has been read already
+		consumed = self.f.tell() - ID3V2_FILE_HEADER_LENGTH
+		data = self.f.read(max(self.tag["size"] - consumed, 0))
+
+		while read < len(data):
+			framedata = self.get_next_frame(data, read)
 			if framedata:
 				try:
 					read += len(framedata)
@@ -295,7 +318,7 @@ class ID3v2:
 				except ID3Exception:
 					pass # ignore unrecognised frames
 			else:
-				self.tag["padding"] = self._read_null_bytes()
+				self.tag["padding"] = self._read_null_bytes(data, read)
 				debug("NULL Padding: %d" % self.tag["padding"])
 				break
 
@@ -308,18 +331,21 @@ class ID3v2:
 			
 		return len(self.frames)
 
-	def get_next_frame(self, search_length):
-
+	def get_next_frame(self, data, offset):
+		"""
+		Return the bytes of the frame starting at offset in the tag data,
+		or '' if padding starts there.
+		"""
 		# skip null frames
-		c = self.f.read(1)
-		self.f.seek(-1, 1)
-		if c == '\x00':
+		if data[offset] == '\x00':
 			return '' # check for NULL frames
-		
-		hdr = self.f.read(id3v2_header_len[self.version])
+
+		hdr_len = id3v2_header_len[self.version]
+		hdr = data[offset:offset + hdr_len]
+		if len(hdr) < hdr_len:
+			return '' # too short to be a frame
 		size = id3v2_data_len[self.version](hdr)
-		data = self.f.read(size)
-		return hdr + data
+		return data[offset:offset + hdr_len + size]
 		
 	def construct_header(self, size):
 		"""
@@ -357,9 +383,7 @@ class ID3v2:
 		return '' # FIXME!
 	
 	def commit(self, pretend=False):
-		framesstring = ''
-		for f in self.frames:
-			framesstring += f.output()
+		framesstring = ''.join([f.output() for f in self.frames])
 
 		footerstring = ''
 		extstring = ''
@@ -371,58 +395,78 @@ class ID3v2:
 
 		# make sure there is enough space from start of file to
 		# end of tag, otherwise realign tag
-		if self.tag["size"] < len(extstring) + len(framesstring):
-			headerstring = self.construct_header(len(framesstring+extstring) \
-												 + ID3V2_FILE_DEFAULT_PADDING)
-			
-			# need to realign - find start of MP3
-			if self.version > 2.2 and self.tag["footer"]:
-				self.f.seek(20 + self.tag["size"])
-			else:
-				self.f.seek(10 + self.tag["size"])
-				
-			# copy everything to a temporary file
-			t = tempfile.TemporaryFile()
-			buf = self.f.read(1024)
-			while buf:
-				t.write(buf)
-				buf = self.f.read(1024)
-				
-			# write to a new file
+		written = len(extstring) + len(framesstring)
+		if self.tag["size"] < written:
+			padding = self.padding_policy(written)
+			headerstring = self.construct_header(written + padding)
+
 			if not pretend:
-				self.f.close()
-				self.f = open(self.filename, 'wb+')
-				self.f.write(headerstring)
-				self.f.write(extstring)
-				self.f.write(framesstring)
-				self.f.write('\x00' * ID3V2_FILE_DEFAULT_PADDING)
-				self.f.write(footerstring)
-				#print t.tell()
-				t.seek(0)
-			
-				buf = t.read(1024)
-				while buf:
-					self.f.write(buf)
-					buf = t.read(1024)
-				t.close()
-				self.f.close()
-				self.f = open(self.filename, 'rb+')
-				self.tag["size"] = len(headerstring) + len(extstring) + \
-								   ID3V2_FILE_DEFAULT_PADDING
-			
+				# find start of MP3
+				if self.version > 2.2 and self.tag["footer"]:
+					audio_start = 20 + self.tag["size"]
+				else:
+					audio_start = 10 + self.tag["size"]
+				self._rewrite(headerstring + extstring + framesstring + \
+							  '\x00' * padding + footerstring, audio_start)
+				self.tag["size"] = written + padding
+				self.tag["padding"] = padding
+
 		else:
 			headerstring = self.construct_header(self.tag["size"])
 			if not pretend:
-				self.f.seek(0)
-				self.f.write(headerstring)
-				self.f.write(extstring)
-				self.f.write(framesstring)
-				written = len(extstring) + len(framesstring)
 				warn("Written Bytes: %d" % written)
-				# add padding
-				self.f.write('\x00' * (self.tag["size"] - written))
-				# add footerstring
-				self.f.write(footerstring)
+				self.f.seek(0)
+				# add padding and footer
+				self.f.write(headerstring + extstring + framesstring + \
+							 '\x00' * (self.tag["size"] - written) + \
+							 footerstring)
 				self.f.flush()
 
-	
+	def _rewrite(self, tagstring, audio_start):
+		"""
+		Replace the file with tagstring followed by the file's contents from
+		audio_start.  The new file is written next to the original, copying
+		in large blocks, and renamed over it, so the original is intact
+		until the new one is complete.
+
+		@param tagstring: the complete tag, including header and padding
+		@type tagstring: string
+		@param audio_start: offset of the data following the old tag
+		@type audio_start: int
+		"""
+		path = os.path.realpath(self.filename)
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+		try:
+			t = os.fdopen(fd, 'wb')
+			try:
+				t.write(tagstring)
+				self.f.seek(audio_start)
+				buf = self.f.read(ID3V2_FILE_COPY_BLOCK_SIZE)
+				while buf:
+					t.write(buf)
+					buf = self.f.read(ID3V2_FILE_COPY_BLOCK_SIZE)
+				t.flush()
+				os.fsync(t.fileno())
+			finally:
+				t.close()
+			os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+
+			# the original cannot be replaced while open on windows
+			self.f.close()
+			try:
+				try:
+					os.rename(tmp, path)
+				except OSError:
+					# windows will not rename over an existing file; on
+					# any other platform the failure is real, and the
+					# original must be left alone
+					if os.name != 'nt':
+						raise
+					os.remove(path)
+					os.rename(tmp, path)
+			finally:
+				self.f = open(self.filename, 'rb+')
+		except:
+			if os.path.exists(tmp):
+				os.remove(tmp)
+			raise